@@ -1,21 +1,479 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, has_request_context, Response, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 import sqlite3
 import bcrypt
 from datetime import datetime
 import re
+import math
 from datetime import datetime, timedelta
 import os
 import base64
+import hashlib
+import struct
+import gzip
+import tempfile
+import queue
+import threading
+import time
+import atexit
+import sys
+import json
+import random
+import heapq
+import logging
+import logging.handlers
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from itertools import islice
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+
+try:
+    from PIL import Image    # 可选依赖：用于生成头像缩略图
+except ImportError:
+    Image = None
 
 app = Flask(__name__)
 CORS(app)
 
 DATABASE_PATH = 'health_app.db'
 
+# ---------------- 日志 ----------------
+# 业务日志先进入内存队列，由后台线程统一格式化并写到stdout，请求线程不再等待终端输出。
+# 日志按接口（视图函数名）区分logger，可以单独调整级别；高频事件按比例采样
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = 10000
+ENDPOINT_LOG_LEVELS = {
+    # 例：'save_realtime_data': 'WARNING'
+}
+LOG_SAMPLE_RATES = {
+    'realtime.received': 0.01,
+    'realtime.saved': 0.01,
+}
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行JSON，附带事件名和结构化字段"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """按事件名采样，未配置采样率的事件全部保留"""
+
+    def filter(self, record):
+        rate = LOG_SAMPLE_RATES.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时直接丢弃日志并计数，不阻塞请求线程"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+logger = logging.getLogger('health_app')
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_handler = DroppingQueueHandler(_log_queue)
+_log_handler.addFilter(SamplingFilter())
+logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+def _parse_endpoint_log_levels(value):
+    """解析 LOG_LEVELS=save_realtime_data=DEBUG,login=WARNING"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        endpoint, _, level = item.partition('=')
+        levels[endpoint.strip()] = level.strip().upper()
+    return levels
+
+ENDPOINT_LOG_LEVELS.update(_parse_endpoint_log_levels(os.environ.get('LOG_LEVELS', '')))
+for _endpoint, _level in ENDPOINT_LOG_LEVELS.items():
+    logging.getLogger(f'health_app.{_endpoint}').setLevel(_level)
+
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(JsonLogFormatter())
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+def log_event(level, event, message, **fields):
+    """记录结构化日志；请求内按当前接口选择logger，级别未开启时不构造日志记录"""
+    endpoint = request.endpoint if has_request_context() else None
+    target = logging.getLogger(f'health_app.{endpoint}') if endpoint else logger
+    if target.isEnabledFor(level):
+        target.log(level, message, extra={'event': event, 'fields': fields})
+
+def logging_snapshot():
+    return {
+        'queue_length': _log_queue.qsize(),
+        'dropped': _log_handler.dropped
+    }
+
+# 连接池配置
+DB_POOL_SIZE = 8                 # 池中最多保留的空闲连接数
+DB_BUSY_TIMEOUT_MS = 5000        # 遇到写锁时的等待时间
+DB_STATEMENT_CACHE_SIZE = 256    # 每个连接缓存的预编译语句数量
+
+class ConnectionPool:
+    """SQLite连接池：连接只配置一次（WAL、busy_timeout、语句缓存），之后在请求间复用"""
+
+    def __init__(self, database_path, max_size=DB_POOL_SIZE):
+        self.database_path = database_path
+        self.max_size = max_size
+        self._idle = queue.LifoQueue(maxsize=max_size)
+
+    def _create_connection(self):
+        # 连接会在不同的请求线程之间传递，但同一时刻只被一个线程使用
+        conn = sqlite3.connect(
+            self.database_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def acquire(self):
+        """取出一个空闲连接，池为空时新建"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._create_connection()
+
+    def release(self, conn):
+        """归还连接：未提交的事务一律回滚，池已满则直接关闭"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+db_pool = ConnectionPool(DATABASE_PATH)
+
+@contextmanager
+def db_connection():
+    """从连接池借出连接，离开with块时自动归还"""
+    conn = db_pool.acquire()
+    try:
+        yield conn
+    finally:
+        db_pool.release(conn)
+
+# 单写者通道配置
+DB_WRITE_QUEUE_SIZE = 1000       # 排队中的写任务上限，超出后直接返回繁忙
+DB_WRITE_TIMEOUT = 5             # 写任务从入队到开始执行的最长等待时间（秒）
+
+class DatabaseWriteBusy(Exception):
+    """写任务队列已满，或任务在截止时间前没有轮到执行"""
+
+class _WriteJob:
+    def __init__(self, func, args, deadline):
+        self.func = func
+        self.args = args
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.state = 'queued'        # queued -> running -> done，或 cancelled / expired
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+class DatabaseWriter:
+    """单写者通道：所有写操作作为任务排队，由同一个后台线程在同一个连接上依次执行并提交。
+
+    SQLite 同一时刻只允许一个写事务，各请求线程各自写入时会互相等待写锁，等不到就报
+    database is locked；集中到一个线程后写入不再争抢，读请求仍在连接池上并发执行（WAL）。
+    每个任务带截止时间，超时仍未开始执行的任务会被放弃，请求得到繁忙提示而不是长时间挂起。
+    """
+
+    def __init__(self, pool, queue_size=DB_WRITE_QUEUE_SIZE, timeout=DB_WRITE_TIMEOUT):
+        self.pool = pool
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._conn = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.expired = 0
+        self._total_wait_ms = 0.0
+        self._total_run_ms = 0.0
+        self._max_run_ms = 0.0
+        self._after_commit = []
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._conn = self.pool.acquire()
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def run(self, func, *args, timeout=None):
+        """在写线程中执行 func(conn, *args) 并提交，返回 func 的结果；func 抛出异常时回滚并原样抛出。
+
+        timeout 秒内没有开始执行时放弃任务并抛出 DatabaseWriteBusy，已经开始执行的任务会等待其完成。
+        在写线程内部嵌套调用时直接执行，与外层任务处于同一事务。
+        返回值会交给调用线程，不要返回游标，游标的回收会与写线程争用同一个连接
+        """
+        if threading.current_thread() is self._thread:
+            return func(self._conn, *args)
+        self._ensure_started()
+        timeout = self.timeout if timeout is None else timeout
+        job = _WriteJob(func, args, time.monotonic() + timeout)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._metrics_lock:
+                self.rejected += 1
+            raise DatabaseWriteBusy('数据库写入队列已满')
+
+        if not job.done.wait(timeout):
+            with job.lock:
+                if job.state == 'queued':
+                    job.state = 'cancelled'
+            if job.state == 'cancelled':
+                with self._metrics_lock:
+                    self.expired += 1
+                raise DatabaseWriteBusy('数据库写入等待超时')
+            job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with job.lock:
+                if job.state == 'cancelled':
+                    continue
+                if time.monotonic() > job.deadline:
+                    job.state = 'expired'
+                    job.error = DatabaseWriteBusy('数据库写入等待超时')
+                else:
+                    job.state = 'running'
+            if job.state == 'expired':
+                with self._metrics_lock:
+                    self.expired += 1
+                job.done.set()
+                continue
+
+            started = time.monotonic()
+            try:
+                job.result = job.func(self._conn, *job.args)
+                self._conn.commit()
+            except Exception as e:
+                job.error = e
+                try:
+                    self._conn.rollback()
+                except sqlite3.Error:
+                    pass
+            callbacks, self._after_commit = self._after_commit, []
+            if job.error is None:
+                for callback, args in callbacks:
+                    try:
+                        callback(*args)
+                    except Exception as e:
+                        log_event(logging.ERROR, 'db_writer.callback_error', '提交后回调执行失败', error=str(e))
+            run_ms = (time.monotonic() - started) * 1000
+            with self._metrics_lock:
+                self.completed += job.error is None
+                self.failed += job.error is not None
+                self._total_wait_ms += (started - job.enqueued_at) * 1000
+                self._total_run_ms += run_ms
+                self._max_run_ms = max(self._max_run_ms, run_ms)
+            job.state = 'done'
+            job.done.set()
+
+    def after_commit(self, callback, *args):
+        """在写任务中登记提交成功后执行的回调，回滚时丢弃。
+
+        回调仍在写线程中按提交顺序执行，用于更新与数据库保持一致的内存索引（排行榜等）
+        """
+        if threading.current_thread() is not self._thread:
+            raise RuntimeError('after_commit 只能在写任务中调用')
+        self._after_commit.append((callback, args))
+
+    def stop(self):
+        """执行完已排队的任务后停止写线程"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=self.timeout * 2)
+        if not self._thread.is_alive():
+            self.pool.release(self._conn)
+
+    def snapshot(self):
+        with self._metrics_lock:
+            finished = self.completed + self.failed
+            return {
+                'queue_length': self._queue.qsize(),
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'avg_wait_ms': round(self._total_wait_ms / finished, 2) if finished else 0,
+                'avg_run_ms': round(self._total_run_ms / finished, 2) if finished else 0,
+                'max_run_ms': round(self._max_run_ms, 2)
+            }
+
+db_writer = DatabaseWriter(db_pool)
+atexit.register(db_writer.stop)
+
+@lru_cache(maxsize=None)
+def build_upsert_sql(table, key_columns, value_columns, increment_columns=(), touch_column=None, returning=None):
+    """生成 INSERT ... ON CONFLICT DO UPDATE 语句；相同的列组合复用同一条SQL，命中连接的语句缓存"""
+    columns = list(key_columns) + list(value_columns)
+    placeholders = ['?'] * len(columns)
+    assignments = []
+    for column in value_columns:
+        if column in increment_columns:
+            assignments.append(f"{column} = {table}.{column} + excluded.{column}")
+        else:
+            assignments.append(f"{column} = excluded.{column}")
+    if touch_column:
+        columns.append(touch_column)
+        placeholders.append('CURRENT_TIMESTAMP')
+        assignments.append(f"{touch_column} = CURRENT_TIMESTAMP")
+    
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(placeholders)}) "
+    sql += f"ON CONFLICT({', '.join(key_columns)}) "
+    sql += f"DO UPDATE SET {', '.join(assignments)}" if assignments else "DO NOTHING"
+    if returning:
+        sql += f" RETURNING {returning}"
+    return sql
+
+def upsert(cursor, table, keys, values, increment_columns=(), touch_column=None, returning=None):
+    """单语句插入或更新：keys为唯一约束列，只合并values中提供的列，其余列保持原值"""
+    sql = build_upsert_sql(
+        table, tuple(keys), tuple(values), tuple(increment_columns), touch_column, returning
+    )
+    return cursor.execute(sql, list(keys.values()) + list(values.values()))
+
+def increment_user_points(cursor, user_id, points):
+    """累加用户总积分并返回最新总积分"""
+    row = upsert(
+        cursor, 'user_points', {'user_id': user_id}, {'total_points': points},
+        increment_columns=('total_points',), touch_column='updated_at', returning='total_points'
+    ).fetchone()
+    return row['total_points'] if row else 0
+
+STREAM_FETCH_SIZE = 500      # 流式输出时每次从游标取出的行数
+STREAM_AUTO_DAYS = 30        # 查询天数达到该值时默认使用流式输出
+
+def wants_stream(days):
+    """stream=1 强制流式，stream=0 强制一次性返回，未指定时按查询天数决定"""
+    stream = request.args.get('stream')
+    if stream is not None:
+        return stream.lower() in ('1', 'true', 'yes')
+    return days >= STREAM_AUTO_DAYS
+
+def stream_json_rows(query, params, key='data', extra=None):
+    """边遍历游标边输出JSON（分块传输），响应格式与 jsonify 版本一致"""
+    return stream_json_iter(lambda conn: conn.execute(query, params), key, extra)
+
+def stream_json_iter(make_rows, key='data', extra=None):
+    """make_rows(conn) 返回逐行产出的可迭代对象，边取边输出JSON。
+
+    连接在生成器内借出，直到最后一块写完才归还；查询中途出错时无法再修改状态码，
+    改为以 success=false 结束响应。
+    """
+    def generate():
+        yield '{' + ''.join(f'{json.dumps(k)}: {json.dumps(v)}, ' for k, v in (extra or {}).items())
+        yield f'{json.dumps(key)}: ['
+        try:
+            with db_connection() as conn:
+                rows = iter(make_rows(conn))
+                separator = ''
+                while True:
+                    chunk = list(islice(rows, STREAM_FETCH_SIZE))
+                    if not chunk:
+                        break
+                    yield separator + ', '.join(json.dumps(dict(row)) for row in chunk)
+                    separator = ', '
+        except Exception as e:
+            log_event(logging.ERROR, 'stream.error', '流式输出异常', error=str(e))
+            yield '], "success": false, "message": ' + json.dumps(f'获取失败: {str(e)}') + '}'
+            return
+        yield '], "success": true}'
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# 数据库结构迁移：按版本号顺序执行，已执行到的版本记录在 PRAGMA user_version 中，
+# 已部署的数据库启动时会自动补齐缺失的迁移。新增表/索引请追加新的迁移，不要修改已发布的迁移
+SCHEMA_MIGRATIONS = []
+
+def migration(version, description):
+    """注册一个结构迁移"""
+    def decorator(func):
+        SCHEMA_MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate_database(conn):
+    """执行所有未执行的迁移，每个迁移与版本号更新在同一个事务中提交"""
+    current_version = get_schema_version(conn)
+    for version, description, func in sorted(SCHEMA_MIGRATIONS, key=lambda m: m[0]):
+        if version <= current_version:
+            continue
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            func(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current_version = version
+        log_event(logging.INFO, 'db.migrated', '数据库迁移完成', version=version, description=description)
+    return current_version
+
 def init_database():
     """初始化数据库"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    with db_connection() as conn:
+        version = migrate_database(conn)
+    log_event(logging.INFO, 'db.ready', '数据库初始化完成', schema_version=version)
+
+@migration(1, '创建基础表')
+def _migration_base_tables(conn):
     cursor = conn.cursor()
     
     # 修改users表创建语句，直接包含avatar_url字段, 用于存储用户头像URL
@@ -136,21 +594,1907 @@ def init_database():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
-        
-    conn.commit()
-    conn.close()
-    print(f"[{datetime.now()}] 数据库初始化完成")
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+@migration(2, '创建步数记录表')
+def _migration_steps_records(conn):
+    # /api/steps-record 和 /api/steps-history 依赖此表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS steps_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            steps INTEGER NOT NULL,
+            points_earned INTEGER NOT NULL,
+            record_date TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, record_date)
+        )
+    ''')
+
+@migration(3, '为热点查询添加索引')
+def _migration_hot_query_indexes(conn):
+    # 实时数据按用户+类型+时间范围查询
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_realtime_user_type_time ON realtime_data (user_id, data_type, time_stamp)')
+    # 步数排行榜按日期筛选并按步数排序
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_health_data_date_steps ON health_data (record_date, steps)')
+    # 积分历史按用户+时间查询
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_points_history_user_time ON points_history (user_id, created_at)')
+    # 反向查询“谁把我加为家庭成员”
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_family_members_member ON family_members (member_id)')
+    # 积分排行榜按总积分排序
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_points_total ON user_points (total_points)')
+    # 面对面加好友按雷达码匹配、按过期时间清理
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_friend_radar_code ON friend_radar (radar_code)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_friend_radar_expires ON friend_radar (expires_at)')
+
+@migration(4, '清理带引号的记录日期')
+def _migration_unquote_record_dates(conn):
+    # 早期客户端上传过 'YYYY-MM-DD' 形式的日期，排行榜曾用TRIM兼容，导致无法走索引。
+    # 统一去掉引号后按日期的查询都可以直接使用索引；与已有日期冲突的行保持原样
+    conn.execute('''
+        UPDATE OR IGNORE health_data SET record_date = TRIM(record_date, "'")
+        WHERE record_date LIKE "'%"
+    ''')
+
+@migration(5, '创建实时数据汇总表')
+def _migration_realtime_rollups(conn):
+    # resolution 为桶宽（分钟），bucket_start 与 realtime_data.time_stamp 同为 'YYYY-MM-DD HH:MM'
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS realtime_rollups (
+            user_id INTEGER NOT NULL,
+            data_type TEXT NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket_start TEXT NOT NULL,
+            min_value REAL,
+            max_value REAL,
+            sum_value REAL,
+            sample_count INTEGER NOT NULL,
+            last_value REAL,
+            last_time TEXT,
+            PRIMARY KEY (user_id, data_type, resolution, bucket_start)
+        ) WITHOUT ROWID
+    ''')
+    # 为已有数据补齐汇总。已发布的迁移不能随代码变化，这里直接读当时的 realtime_data 表，
+    # 不调用 refresh_realtime_rollups（它已改为读月分区）；之后搬迁任务会按相同口径重算受影响的桶
+    conn.execute('''
+        INSERT OR REPLACE INTO realtime_rollups (user_id, data_type, resolution, bucket_start,
+                                                 min_value, max_value, sum_value, sample_count, last_value, last_time)
+        SELECT user_id, data_type, 5, bucket_start,
+               MIN(value), MAX(value), SUM(value), COUNT(*),
+               MAX(CASE WHEN latest = 1 THEN value END), MAX(time_stamp)
+        FROM (
+            SELECT user_id, data_type, value, time_stamp, bucket_start,
+                   ROW_NUMBER() OVER (PARTITION BY user_id, data_type, bucket_start ORDER BY time_stamp DESC) AS latest
+            FROM (
+                SELECT user_id, data_type, value, time_stamp,
+                       substr(time_stamp, 1, 14) || printf('%02d', CAST(substr(time_stamp, 15, 2) AS INTEGER) / 5 * 5)
+                           AS bucket_start
+                FROM realtime_data
+                WHERE datetime(substr(time_stamp, 1, 16)) IS NOT NULL AND typeof(value) IN ('integer', 'real')
+            )
+        )
+        GROUP BY user_id, data_type, bucket_start
+    ''')
+    # 小时桶由5分钟桶合并，天桶由小时桶合并
+    for resolution, child_resolution, bucket_sql in (
+        (60, 5, "substr(bucket_start, 1, 14) || '00'"),
+        (1440, 60, "substr(bucket_start, 1, 11) || '00:00'"),
+    ):
+        conn.execute(f'''
+            INSERT OR REPLACE INTO realtime_rollups (user_id, data_type, resolution, bucket_start,
+                                                     min_value, max_value, sum_value, sample_count, last_value, last_time)
+            SELECT user_id, data_type, ?, parent_start,
+                   MIN(min_value), MAX(max_value), SUM(sum_value), SUM(sample_count),
+                   MAX(CASE WHEN latest = 1 THEN last_value END), MAX(last_time)
+            FROM (
+                SELECT user_id, data_type, min_value, max_value, sum_value, sample_count, last_value, last_time,
+                       {bucket_sql} AS parent_start,
+                       ROW_NUMBER() OVER (PARTITION BY user_id, data_type, {bucket_sql} ORDER BY last_time DESC) AS latest
+                FROM realtime_rollups
+                WHERE resolution = ?
+            )
+            GROUP BY user_id, data_type, parent_start
+        ''', (resolution, child_resolution))
+
+@migration(6, '创建紧凑的实时数据样本表')
+def _migration_realtime_samples(conn):
+    # 数据类型用小整数编码，时间戳为UTC纪元分钟数（按本地时间字面值换算），去掉record_date和created_at
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS realtime_metrics (
+            code INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )
+    ''')
+    conn.executemany(
+        'INSERT OR IGNORE INTO realtime_metrics (code, name) VALUES (?, ?)',
+        [(index + 1, name) for index, name in enumerate(VALID_REALTIME_DATA_TYPES)]
+    )
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS realtime_samples (
+            user_id INTEGER NOT NULL,
+            metric INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (user_id, metric, ts)
+        ) WITHOUT ROWID
+    ''')
+    # 旧表 realtime_data 的数据在服务运行时分批搬迁，见 LegacyRealtimeMigrator
+
+@migration(7, '创建维护任务租约表')
+def _migration_maintenance_leases(conn):
+    # 每个维护任务一行，expires_at 为租约到期的 Unix 时间，到期前其他进程不会重复执行
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_leases (
+            job TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+@migration(8, '创建实时数据归档索引表')
+def _migration_realtime_archive_index(conn):
+    # 每个用户每个月一个归档文件，path 为相对 REALTIME_ARCHIVE_DIR 的路径
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS realtime_archive_index (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            path TEXT NOT NULL,
+            sample_count INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    ''')
+    # 过期清理按月份查找
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_realtime_archive_month ON realtime_archive_index (month)')
 
 def validate_phone(phone: str) -> bool:
     """验证手机号格式"""
     pattern = r'^1[3-9]\d{9}$'
     return re.match(pattern, phone) is not None
 
+HEALTH_DATA_FIELDS = [
+    'steps', 'steps_goal', 'distance', 'calories_burned',
+    'current_heart_rate', 'resting_heart_rate', 'min_heart_rate', 'avg_heart_rate', 'max_heart_rate',
+    'current_blood_oxygen', 'min_blood_oxygen', 'avg_blood_oxygen', 'max_blood_oxygen',
+    'sleep_score', 'sleep_duration', 'sleep_start_time', 'sleep_end_time',
+    'deep_sleep_duration', 'light_sleep_duration', 'rem_sleep_duration', 'awake_duration',
+    'active_calories', 'calories_goal', 'basic_metabolism_calories',
+    'current_mood'
+]
+
+VALID_REALTIME_DATA_TYPES = ['heart_rate', 'blood_oxygen', 'mood']
+REALTIME_KEY_COLUMNS = ('user_id', 'metric', 'ts')
+MAX_REALTIME_BATCH_SIZE = 5000   # 单次批量上传的最大样本数（一天的分钟级心率约1440条）
+
+def is_numeric_value(value):
+    """样本数值只接受数字；JSON 的 true/false 在 Python 中是 bool（int 的子类），同样拒绝"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def normalize_time_stamp(time_stamp, current_date=None):
+    """时间格式验证和标准化 - 支持 YYYY-MM-DD HH:MM 和 HH:MM，返回 (标准化时间, 错误信息)"""
+    if not isinstance(time_stamp, str) or ':' not in time_stamp:
+        return None, '时间格式错误，应为YYYY-MM-DD HH:MM或HH:MM'
+
+    # 处理完整日期时间格式
+    if ' ' in time_stamp and '-' in time_stamp:
+        try:
+            datetime.strptime(time_stamp, '%Y-%m-%d %H:%M')
+        except ValueError:
+            return None, '日期时间格式无效，应为YYYY-MM-DD HH:MM'
+        return time_stamp, None
+
+    # 处理只有时间的格式，补充当前日期
+    time_parts = time_stamp.split(':')
+    if len(time_parts) != 2:
+        return None, '时间格式错误'
+    try:
+        hour = int(time_parts[0])
+        minute = int(time_parts[1])
+    except ValueError:
+        return None, '时间格式无效'
+    if hour < 0 or hour > 23 or minute < 0 or minute > 59:
+        return None, '时间值超出范围'
+    if current_date is None:
+        current_date = datetime.now().strftime('%Y-%m-%d')
+    return f"{current_date} {hour:02d}:{minute:02d}", None
+
+# ==================== 实时数据样本存储 ====================
+
+_EPOCH = datetime(1970, 1, 1)
+_metric_codes = {}
+_metric_codes_lock = threading.Lock()
+
+def to_epoch_minute(time_stamp):
+    """'YYYY-MM-DD HH:MM' -> 纪元分钟数（按字面值当作UTC换算，与SQLite的unixepoch互逆）"""
+    moment = datetime.strptime(time_stamp[:16], '%Y-%m-%d %H:%M')
+    return int((moment - _EPOCH).total_seconds()) // 60
+
+def from_epoch_minute(ts):
+    return (_EPOCH + timedelta(minutes=ts)).strftime('%Y-%m-%d %H:%M')
+
+def metric_code(name, create=False):
+    """数据类型名 -> 整数编码，结果常驻内存。
+
+    新类型需要写入 realtime_metrics，作为单独的写任务提交，
+    因此 create=True 不能在写任务内部调用。未登记且不创建时返回 None。
+    """
+    code = _metric_codes.get(name)
+    if code is not None:
+        return code
+    with _metric_codes_lock:
+        with db_connection() as conn:
+            row = conn.execute('SELECT code FROM realtime_metrics WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            if not create:
+                return None
+            row = db_writer.run(lambda conn: conn.execute(
+                'INSERT INTO realtime_metrics (name) VALUES (?) RETURNING code', (name,)
+            ).fetchone())
+        _metric_codes[name] = row[0]
+        return row[0]
+
+REALTIME_RETENTION_DAYS = int(os.environ.get('REALTIME_RETENTION_DAYS', 0))   # 原始样本保留天数，默认 0 表示永久保留，需运维显式开启
+REALTIME_PARTITION_DIR = os.path.join(os.path.dirname(DATABASE_PATH), 'realtime_partitions')
+
+_PARTITION_SCHEMA_SQL = ('''
+    CREATE TABLE IF NOT EXISTS {schema}.realtime_samples (
+        user_id INTEGER NOT NULL,
+        metric INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (user_id, metric, ts)
+    ) WITHOUT ROWID
+''', '''
+    CREATE TABLE IF NOT EXISTS {schema}.realtime_blocks (
+        user_id INTEGER NOT NULL,
+        metric INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        sample_count INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (user_id, metric, day)
+    ) WITHOUT ROWID
+''')   # realtime_blocks 为压缩块存储（见 RealtimeBlocks），day 为纪元天数
+
+def realtime_retention_cutoff():
+    """早于该纪元分钟数的原始样本已过保留期：不再写入，所在月份整体删除。永久保留时返回 None"""
+    if REALTIME_RETENTION_DAYS <= 0:
+        return None
+    return to_epoch_minute((datetime.now() - timedelta(days=REALTIME_RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M'))
+
+def partition_month(ts):
+    """纪元分钟数 -> 所属月份分区 'YYYYMM'"""
+    return (_EPOCH + timedelta(minutes=ts)).strftime('%Y%m')
+
+def month_bounds(month):
+    """月份分区覆盖的时间范围 [起点, 终点)，单位为纪元分钟"""
+    start = datetime.strptime(month, '%Y%m')
+    end = (start + timedelta(days=32)).replace(day=1)
+    return int((start - _EPOCH).total_seconds()) // 60, int((end - _EPOCH).total_seconds()) // 60
+
+def months_between(ts_start, ts_end):
+    """与 [ts_start, ts_end) 有交集的月份，按时间升序"""
+    months = []
+    month = partition_month(ts_start)
+    while ts_start < ts_end and month_bounds(month)[0] < ts_end:
+        months.append(month)
+        month = partition_month(month_bounds(month)[1])
+    return months
+
+class RealtimePartitions:
+    """原始样本按月分区：每个月一个独立的数据库文件，按需 ATTACH 到连接上（schema 为 rt_YYYYMM）。
+
+    读写只挂载时间范围涉及的月份，挂载过的分区随连接留在池中复用；
+    超过 SQLite 的挂载上限时先卸载本次用不到的分区。过期数据整月删除文件即可，
+    不需要逐行 DELETE，也不会在主库中留下空闲页。
+    """
+
+    def __init__(self, directory=REALTIME_PARTITION_DIR):
+        self.directory = directory
+        self._months = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    @staticmethod
+    def schema(month):
+        return f'rt_{month}'
+
+    def path(self, month):
+        return os.path.join(self.directory, f'realtime_{month}.db')
+
+    def months(self, refresh=False):
+        """已存在的月份分区，按时间升序"""
+        with self._lock:
+            if self._months is None or refresh:
+                names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+                self._months = {name[9:15] for name in names
+                                if re.fullmatch(r'realtime_\d{6}\.db', name)}
+            return sorted(self._months)
+
+    def _exists(self, month):
+        # 缓存只作为目录列表的快照，以文件为准：其他进程可能新建或删除了分区，
+        # 而 ATTACH 一个不存在的文件会创建出空库
+        exists = os.path.exists(self.path(month))
+        self.months()
+        with self._lock:
+            if exists:
+                self._months.add(month)
+            else:
+                self._months.discard(month)
+        return exists
+
+    def attach(self, conn, months, create=False):
+        """确保这些月份的分区已挂载到连接上，返回实际存在的月份。
+
+        create=True 时新建缺少的分区。需要卸载分区腾出名额时不能处于事务中，
+        因此写入方应在开启事务前挂载好本次涉及的全部月份。
+        """
+        wanted = [month for month in dict.fromkeys(months) if create or self._exists(month)]
+        limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if len(wanted) > limit:
+            raise ValueError(f'单次最多访问{limit}个月份分区')
+
+        attached = {row['name']: row['file'] for row in conn.execute('PRAGMA database_list')
+                    if row['name'].startswith('rt_')}
+        # 文件已被删除（过期清理）的分区先卸载
+        detach = {name for name, file in attached.items() if not os.path.exists(file)}
+        keep = {self.schema(month) for month in wanted}
+        missing = [month for month in wanted if self.schema(month) not in attached.keys() - detach]
+        overflow = len(attached) - len(detach) + len(missing) - limit
+        if overflow > 0:
+            detach |= set(sorted(attached.keys() - detach - keep)[:overflow])
+        if detach and conn.in_transaction:
+            raise RuntimeError('事务中无法卸载分区，请在开启事务前挂载')
+        for name in detach:
+            conn.execute(f'DETACH DATABASE {name}')
+
+        for month in missing:
+            schema = self.schema(month)
+            created = create and not self._exists(month)
+            if created:
+                os.makedirs(self.directory, exist_ok=True)
+            conn.execute(f'ATTACH DATABASE ? AS {schema}', (self.path(month),))
+            conn.execute(f'PRAGMA {schema}.synchronous=NORMAL')
+            if created and not conn.in_transaction:
+                conn.execute(f'PRAGMA {schema}.journal_mode=WAL')
+            # 较早创建的分区可能缺少后来新增的表
+            for statement in _PARTITION_SCHEMA_SQL:
+                conn.execute(statement.format(schema=schema))
+            if created:
+                with self._lock:
+                    self._months.add(month)
+                log_event(logging.INFO, 'partition.created', '创建实时数据月分区', month=month)
+        return wanted
+
+    def drop(self, month):
+        """整月删除分区文件；其他连接在下次挂载时发现文件已删除会自动卸载"""
+        with self._lock:
+            if self._months is not None:
+                self._months.discard(month)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path(month) + suffix)
+            except FileNotFoundError:
+                pass
+        self.dropped += 1
+        log_event(logging.INFO, 'partition.dropped', '删除过期的实时数据月分区', month=month)
+
+    def snapshot(self):
+        months = self.months()
+        sizes = {}
+        for month in months:
+            try:
+                sizes[month] = os.path.getsize(self.path(month))
+            except OSError:
+                pass
+        return {'months': months, 'bytes': sum(sizes.values()), 'dropped': self.dropped}
+
+realtime_partitions = RealtimePartitions()
+
+def _select_samples_sql(schema, metric):
+    # 存储为整数编码，返回时还原成原来的字符串格式
+    return f'''
+        SELECT s.user_id, date(s.ts * 60, 'unixepoch') AS record_date,
+               strftime('%Y-%m-%d %H:%M', s.ts * 60, 'unixepoch') AS time_stamp,
+               m.name AS data_type, s.value
+        FROM {schema}.realtime_samples s JOIN main.realtime_metrics m ON m.code = s.metric
+        WHERE s.user_id = ? AND s.ts >= ? AND s.ts < ?{'' if metric is None else ' AND s.metric = ?'}
+    '''
+
+def _select_samples_params(user_id, ts_start, ts_end, metric):
+    return [user_id, ts_start, ts_end] + ([] if metric is None else [metric])
+
+class LegacyRealtimeMigrator:
+    """把分区之前的实时数据分批搬到月分区：最早的 realtime_data 表，以及主库中的 realtime_samples 表。
+
+    每批在一个短事务里复制、删除旧行并刷新对应的汇总，服务照常读写；
+    搬迁期间查询会合并旧表中尚未搬走的行。旧表搬空后在下次启动时删除。
+    """
+
+    SOURCES = ('realtime_data', 'realtime_samples')
+
+    def __init__(self, chunk_size=2000, pause=0.05):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.sources = []
+        self.moved = 0
+        self.invalid = 0    # 时间无法解析或数值为空而丢弃的行
+        self._thread = None
+
+    @property
+    def pending(self):
+        return bool(self.sources)
+
+    def prepare(self):
+        """启动时检查旧表：不存在或已搬空则直接删除，否则标记为搬迁中"""
+        sources = []
+        with db_connection() as conn:
+            for table in self.SOURCES:
+                exists = conn.execute(
+                    "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+                ).fetchone()
+                if not exists:
+                    continue
+                if conn.execute(f'SELECT 1 FROM main.{table} LIMIT 1').fetchone() is None:
+                    db_writer.run(lambda conn: conn.execute(f'DROP TABLE main.{table}').rowcount)
+                    log_event(logging.INFO, 'realtime_migrate.dropped', '旧实时数据表已删除', table=table)
+                else:
+                    sources.append(table)
+            names = {row[0] for row in conn.execute('SELECT name FROM realtime_metrics')}
+            if 'realtime_data' in sources:
+                names.update(row[0] for row in conn.execute('SELECT DISTINCT data_type FROM main.realtime_data'))
+        for name in names:
+            metric_code(name, create=True)
+        self.sources = sources
+        return self.pending
+
+    def start(self):
+        if self.prepare() and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='realtime-migrate', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        log_event(logging.INFO, 'realtime_migrate.start', '开始搬迁旧实时数据', sources=self.sources)
+        try:
+            while self.sources:
+                if self.move_chunk():
+                    time.sleep(self.pause)
+                else:
+                    self.sources.pop(0)
+        except Exception as e:
+            log_event(logging.ERROR, 'realtime_migrate.error', '搬迁旧实时数据异常', error=str(e), moved=self.moved)
+            return
+        log_event(logging.INFO, 'realtime_migrate.done', '旧实时数据搬迁完成', moved=self.moved, invalid=self.invalid)
+
+    def _read_chunk(self, conn, source):
+        """读取一批旧行，统一为 (删除键, user_id, data_type, time_stamp, ts, value)，时间无法解析时 ts 为 None"""
+        if source == 'realtime_data':
+            chunk = []
+            for row in conn.execute(
+                'SELECT id, user_id, data_type, time_stamp, value FROM main.realtime_data ORDER BY id LIMIT ?',
+                (self.chunk_size,)
+            ):
+                try:
+                    ts = to_epoch_minute(row['time_stamp'])
+                except (TypeError, ValueError):
+                    ts = None
+                chunk.append(((row['id'],), row['user_id'], row['data_type'], row['time_stamp'], ts, row['value']))
+            return chunk
+        return [
+            ((row['user_id'], row['metric'], row['ts']), row['user_id'], row['name'],
+             from_epoch_minute(row['ts']), row['ts'], row['value'])
+            for row in conn.execute('''
+                SELECT s.user_id, s.metric, s.ts, s.value, m.name
+                FROM main.realtime_samples s LEFT JOIN main.realtime_metrics m ON m.code = s.metric
+                ORDER BY s.user_id, s.metric, s.ts LIMIT ?
+            ''', (self.chunk_size,))
+        ]
+
+    def move_chunk(self):
+        """搬迁当前旧表的一批数据，返回本批处理的行数；已存在的新样本（搬迁期间写入的）优先保留。
+
+        不按保留期过滤：旧数据全部搬进分区，之后由归档和保留期任务按各自的配置处理。
+        只有时间无法解析或数值为空、无法存入分区的行被丢弃。
+        分区必须在事务开始前挂载，一批最多涉及挂载上限个月份，其余月份留给下一批
+        """
+        source = self.sources[0]
+        
+        def move(conn):
+            months = []
+            for _, _, _, _, ts, _ in self._read_chunk(conn, source):
+                if ts is not None and partition_month(ts) not in months:
+                    months.append(partition_month(ts))
+            months = months[:conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)]
+            realtime_partitions.attach(conn, months, create=True)
+
+            conn.execute('BEGIN IMMEDIATE')
+            inserts = {}
+            deleted = []
+            touched = []
+            for key, user_id, data_type, time_stamp, ts, value in self._read_chunk(conn, source):
+                code = _metric_codes.get(data_type)
+                if ts is not None and code is not None and value is not None:
+                    month = partition_month(ts)
+                    if month not in months:
+                        continue
+                    inserts.setdefault(month, []).append((user_id, code, ts, value))
+                    touched.append((user_id, data_type, time_stamp))
+                else:
+                    self.invalid += 1
+                deleted.append(key)
+            for month, samples in inserts.items():
+                schema = RealtimePartitions.schema(month)
+                realtime_blocks.expand(conn, schema, {(user_id, code, ts // 1440) for user_id, code, ts, _ in samples})
+                conn.executemany(f'''
+                    INSERT OR IGNORE INTO {schema}.realtime_samples (user_id, metric, ts, value)
+                    VALUES (?, ?, ?, ?)
+                ''', samples)
+            if source == 'realtime_data':
+                conn.executemany('DELETE FROM main.realtime_data WHERE id = ?', deleted)
+            else:
+                conn.executemany(
+                    'DELETE FROM main.realtime_samples WHERE user_id = ? AND metric = ? AND ts = ?', deleted
+                )
+            refresh_realtime_rollups(conn, touched)
+            return len(touched), len(deleted)
+
+        moved, processed = db_writer.run(move)
+        self.moved += moved
+        return processed
+
+    def discard(self, conn, samples):
+        """搬迁期间写入新样本时，删除旧表中同一时刻的行，避免查询合并时重复"""
+        sources = list(self.sources)
+        if 'realtime_data' in sources:
+            conn.executemany('''
+                DELETE FROM main.realtime_data
+                WHERE user_id = ? AND data_type = ? AND time_stamp IN (?, ? || ':00')
+            ''', [(user_id, data_type, time_stamp, time_stamp) for user_id, data_type, time_stamp in samples])
+        if 'realtime_samples' in sources:
+            conn.executemany(
+                'DELETE FROM main.realtime_samples WHERE user_id = ? AND metric = ? AND ts = ?',
+                [(user_id, metric_code(data_type), to_epoch_minute(time_stamp))
+                 for user_id, data_type, time_stamp in samples]
+            )
+
+    def rows(self, conn, user_id, ts_start, ts_end, data_type=None):
+        """旧表中尚未搬迁的行，按时间倒序一次取出"""
+        sources = list(self.sources)
+        parts, params = [], []
+        if 'realtime_data' in sources:
+            parts.append('''
+                SELECT user_id, record_date, substr(time_stamp, 1, 16) AS time_stamp, data_type, value
+                FROM main.realtime_data WHERE user_id = ? AND record_date BETWEEN ? AND ?
+            ''' + (' AND data_type = ?' if data_type else ''))
+            params += [user_id, from_epoch_minute(ts_start)[:10], from_epoch_minute(ts_end - 1)[:10]]
+            params += [data_type] if data_type else []
+        metric = metric_code(data_type) if data_type else None
+        if 'realtime_samples' in sources and not (data_type and metric is None):
+            parts.append(_select_samples_sql('main', metric))
+            params += _select_samples_params(user_id, ts_start, ts_end, metric)
+        if not parts:
+            return []
+        return conn.execute(' UNION ALL '.join(parts) + ' ORDER BY time_stamp DESC', params).fetchall()
+
+    def snapshot(self):
+        return {'pending': self.pending, 'sources': list(self.sources), 'moved': self.moved, 'invalid': self.invalid}
+
+legacy_realtime_migrator = LegacyRealtimeMigrator()
+
+def save_realtime_samples(samples):
+    """写入实时样本并刷新汇总，samples 为 (user_id, data_type, 'YYYY-MM-DD HH:MM', ts, value)。
+
+    按月份路由到对应分区；涉及的月份超过挂载上限时按月份分组，每组一个事务
+    """
+    rows_by_month = {}
+    for user_id, data_type, time_stamp, ts, value in samples:
+        rows_by_month.setdefault(partition_month(ts), []).append(
+            (user_id, metric_code(data_type, create=True), ts, value, data_type, time_stamp)
+        )
+
+    def write(conn, months):
+        group_size = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        for start in range(0, len(months), group_size):
+            group = months[start:start + group_size]
+            realtime_partitions.attach(conn, group, create=True)
+            written = []
+            for month in group:
+                rows = rows_by_month[month]
+                schema = RealtimePartitions.schema(month)
+                realtime_blocks.expand(conn, schema, {(row[0], row[1], row[2] // 1440) for row in rows})
+                conn.executemany(
+                    build_upsert_sql(f'{schema}.realtime_samples', REALTIME_KEY_COLUMNS, ('value',)),
+                    [row[:4] for row in rows]
+                )
+                written += [(user_id, data_type, time_stamp) for user_id, _, _, _, data_type, time_stamp in rows]
+            legacy_realtime_migrator.discard(conn, written)
+            refresh_realtime_rollups(conn, written)
+            conn.commit()
+
+    db_writer.run(write, sorted(rows_by_month))
+
+REALTIME_BUFFER_CAPACITY = 50000      # 写缓冲中最多积压的样本数，超出后拒绝写入
+REALTIME_FLUSH_BATCH = 5000           # 积压达到该样本数时立即提交
+REALTIME_FLUSH_INTERVAL = 0.05        # 最早入队的样本最多等待的秒数
+REALTIME_FLUSH_TIMEOUT = 10           # 请求等待所在批次提交的最长时间（秒）
+REALTIME_FLUSH_RETRIES = 3            # 数据库繁忙时整批重试的次数
+REALTIME_WRITE_ACK = os.environ.get('REALTIME_WRITE_ACK', 'commit')   # commit：提交后返回；accepted：入队即返回
+
+class RealtimeWriteBusy(DatabaseWriteBusy):
+    """写缓冲已满或等待提交超时"""
+
+class _FlushTicket:
+    def __init__(self):
+        self._done = threading.Event()
+        self.error = None
+
+    def finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout):
+        if not self._done.wait(timeout):
+            raise RealtimeWriteBusy('等待实时数据提交超时')
+        if self.error is not None:
+            raise self.error
+
+class RealtimeWriteBuffer:
+    """实时样本写缓冲：请求线程只做校验和入队，后台线程把多个请求的样本合并到同一批事务提交（group commit），
+    写锁和 fsync 按批次而不是按请求计，吞吐随批量增大。
+
+    默认请求等到所在批次提交后再返回；REALTIME_WRITE_ACK=accepted 时入队即返回，
+    进程异常退出会丢失尚未提交的样本。缓冲区满时拒绝写入，正常退出前会写完缓冲区。
+    """
+
+    def __init__(self, capacity=REALTIME_BUFFER_CAPACITY, batch_size=REALTIME_FLUSH_BATCH,
+                 interval=REALTIME_FLUSH_INTERVAL):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._pending = []           # (samples, ticket)
+        self._pending_count = 0
+        self._first_at = None
+        self._stopping = False
+        self._thread = None
+        self.flushes = 0
+        self.flushed_samples = 0
+        self.max_batch = 0
+        self.rejected = 0
+        self.failed = 0
+        self._total_ms = 0.0
+
+    def submit(self, samples, wait=None):
+        """入队一组已校验的样本 (user_id, data_type, time_stamp, ts, value)；wait 默认由 REALTIME_WRITE_ACK 决定"""
+        if wait is None:
+            wait = REALTIME_WRITE_ACK != 'accepted'
+        ticket = _FlushTicket()
+        with self._cond:
+            if self._stopping or self._pending_count + len(samples) > self.capacity:
+                self.rejected += 1
+                raise RealtimeWriteBusy('实时数据写入队列已满')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='realtime-writer', daemon=True)
+                self._thread.start()
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append((samples, ticket))
+            self._pending_count += len(samples)
+            self._cond.notify()
+        if wait:
+            ticket.wait(REALTIME_FLUSH_TIMEOUT)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # 攒到批量或等到最早一条样本超时，停止时立即提交剩余的样本
+                deadline = self._first_at + self.interval
+                while self._pending_count < self.batch_size and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending, self._pending_count = self._pending, [], 0
+            self._flush(batch)
+
+    def _flush(self, batch):
+        samples = [sample for chunk, _ in batch for sample in chunk]
+        started = time.perf_counter()
+        error = None
+        for attempt in range(REALTIME_FLUSH_RETRIES):
+            try:
+                save_realtime_samples(samples)
+                error = None
+                break
+            except (sqlite3.OperationalError, DatabaseWriteBusy) as e:
+                # 数据库繁忙、写队列排满等临时错误，整批重试
+                error = e
+                time.sleep(0.1 * (attempt + 1))
+            except Exception as e:
+                error = e
+                break
+
+        if error is not None and not isinstance(error, (sqlite3.OperationalError, DatabaseWriteBusy)) and len(batch) > 1:
+            # 个别请求的数据导致整批失败时逐个请求提交，只让有问题的请求失败
+            for chunk, ticket in batch:
+                try:
+                    save_realtime_samples(chunk)
+                    ticket.finish()
+                except Exception as e:
+                    self._record_failure(e, len(chunk))
+                    ticket.finish(e)
+        else:
+            if error is not None:
+                self._record_failure(error, len(samples))
+            for _, ticket in batch:
+                ticket.finish(error)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._cond:
+            self.flushes += 1
+            self.flushed_samples += len(samples)
+            self.max_batch = max(self.max_batch, len(samples))
+            self._total_ms += elapsed_ms
+
+    def _record_failure(self, error, count):
+        with self._cond:
+            self.failed += count
+        log_event(logging.ERROR, 'realtime_buffer.flush_error', '实时数据批量提交失败', error=str(error), samples=count)
+
+    def stop(self):
+        """停止接收新样本，并等待缓冲区中的样本全部提交"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=REALTIME_FLUSH_TIMEOUT)
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'ack': REALTIME_WRITE_ACK,
+                'queued_samples': self._pending_count,
+                'capacity': self.capacity,
+                'flushes': self.flushes,
+                'flushed_samples': self.flushed_samples,
+                'avg_batch': round(self.flushed_samples / self.flushes, 1) if self.flushes else 0,
+                'max_batch': self.max_batch,
+                'avg_flush_ms': round(self._total_ms / self.flushes, 2) if self.flushes else 0,
+                'rejected': self.rejected,
+                'failed': self.failed
+            }
+
+realtime_write_buffer = RealtimeWriteBuffer()
+atexit.register(realtime_write_buffer.stop)
+
+def iter_realtime_rows(conn, user_id, ts_start, ts_end, data_type=None):
+    """按时间倒序逐行返回 [ts_start, ts_end) 内的原始样本，只访问时间范围涉及的月份分区。
+
+    分区按月份从新到旧依次挂载查询，同一时刻只有一个分区的游标在读；分区内合并逐行样本和压缩块，
+    已归档的月份从归档文件读取，搬迁未完成时合并旧表中的行
+    """
+    metric = metric_code(data_type) if data_type else None
+
+    def partition_rows():
+        if data_type and metric is None:
+            return
+        for month in reversed(months_between(ts_start, ts_end)):
+            live = ()
+            if realtime_partitions.attach(conn, [month]):
+                schema = RealtimePartitions.schema(month)
+                live = heapq.merge(
+                    conn.execute(_select_samples_sql(schema, metric) + ' ORDER BY s.ts DESC',
+                                 _select_samples_params(user_id, ts_start, ts_end, metric)),
+                    realtime_blocks.rows(conn, schema, user_id, ts_start, ts_end, metric),
+                    key=lambda row: row['time_stamp'], reverse=True
+                )
+            # 归档时先提交索引再删除分区，所以先查分区、后查索引不会漏掉数据
+            archived = realtime_archive.lookup(conn, user_id, month)
+            if archived:
+                yield from realtime_archive.merge(archived, live, user_id, ts_start, ts_end, data_type)
+            else:
+                yield from live
+
+    rows = partition_rows()
+    if legacy_realtime_migrator.pending:
+        # 旧表的行先整体取出，避免与分区游标交替执行时无法卸载分区
+        rows = heapq.merge(rows, legacy_realtime_migrator.rows(conn, user_id, ts_start, ts_end, data_type),
+                           key=lambda row: row['time_stamp'], reverse=True)
+    return (dict(row) for row in rows)
+
+# ==================== 实时数据冷归档 ====================
+
+REALTIME_HOT_DAYS = int(os.environ.get('REALTIME_HOT_DAYS', 90))   # 超出该天数的整月样本转为冷归档，0 表示不归档
+REALTIME_ARCHIVE_DIR = os.path.join(os.path.dirname(DATABASE_PATH), 'realtime_archive')
+REALTIME_ARCHIVE_CACHE_SIZE = 8    # 最近读取过的归档文件在内存中保留的份数
+
+def realtime_archive_cutoff():
+    """整月都早于该纪元分钟数的分区会被归档，不归档时返回 None"""
+    if REALTIME_HOT_DAYS <= 0:
+        return None
+    return to_epoch_minute((datetime.now() - timedelta(days=REALTIME_HOT_DAYS)).strftime('%Y-%m-%d %H:%M'))
+
+def realtime_write_floor():
+    """早于该纪元分钟数的样本不再接受写入：已过保留期，或所在月份已转为冷归档。没有限制时返回 None"""
+    floors = [realtime_retention_cutoff()]
+    archive_cutoff = realtime_archive_cutoff()
+    if archive_cutoff is not None:
+        floors.append(month_bounds(partition_month(archive_cutoff))[0])
+    floors = [floor for floor in floors if floor is not None]
+    return max(floors) if floors else None
+
+@lru_cache(maxsize=REALTIME_ARCHIVE_CACHE_SIZE)
+def _load_archive(path, mtime_ns):
+    # mtime 作为缓存键的一部分，归档文件被重写后自动失效
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return tuple((item['ts'], item['data_type'], item['value']) for item in map(json.loads, f))
+
+class RealtimeArchive:
+    """超出热数据窗口的月份按用户转存为 gzip 压缩的 NDJSON 文件（每行一个样本），
+    realtime_archive_index 记录每个用户每个月的归档文件。
+
+    归档先写文件和索引、最后删除分区，读取时先查分区再查索引，因此任何时刻都能读到完整数据；
+    同一月份再次归档时与已有文件合并。归档后的月份不再接受写入。
+    """
+
+    def __init__(self, directory=REALTIME_ARCHIVE_DIR):
+        self.directory = directory
+        self.archived_files = 0
+        self.archived_samples = 0
+        self.cold_reads = 0
+
+    @staticmethod
+    def relative_path(user_id, month):
+        return f'{month}/{user_id}.ndjson.gz'
+
+    def lookup(self, conn, user_id, month):
+        row = conn.execute('SELECT path FROM main.realtime_archive_index WHERE user_id = ? AND month = ?',
+                           (user_id, month)).fetchone()
+        return row['path'] if row else None
+
+    def read(self, path):
+        """读取归档文件，返回按时间升序的 (ts, data_type, value)"""
+        full_path = os.path.join(self.directory, path)
+        self.cold_reads += 1
+        try:
+            return _load_archive(full_path, os.stat(full_path).st_mtime_ns)
+        except FileNotFoundError:
+            # 查到索引后文件才被保留期清理删除，这些样本已过期
+            return ()
+
+    def write(self, path, samples):
+        """samples 为按时间升序的 (ts, data_type, value)，先写临时文件再改名，返回文件字节数"""
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                for ts, data_type, value in samples:
+                    f.write((json.dumps({'ts': ts, 'data_type': data_type, 'value': value}) + '\n').encode('utf-8'))
+            os.replace(temp_path, full_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return os.path.getsize(full_path)
+
+    def merge(self, path, live_rows, user_id, ts_start, ts_end, data_type=None):
+        """合并归档文件与分区中的行（分区优先），返回 [ts_start, ts_end) 内按时间倒序的行"""
+        rows = {(row['time_stamp'], row['data_type']): dict(row) for row in live_rows}
+        for ts, name, value in self.read(path):
+            if ts_start <= ts < ts_end and (not data_type or name == data_type):
+                time_stamp = from_epoch_minute(ts)
+                rows.setdefault((time_stamp, name), {
+                    'user_id': user_id, 'record_date': time_stamp[:10], 'time_stamp': time_stamp,
+                    'data_type': name, 'value': value
+                })
+        return sorted(rows.values(), key=lambda row: row['time_stamp'], reverse=True)
+
+    def archive_month(self, month):
+        """把一个月分区中的样本逐个用户写入归档，全部完成后删除分区"""
+        schema = RealtimePartitions.schema(month)
+        users = samples = 0
+        with db_connection() as conn:
+            if not realtime_partitions.attach(conn, [month]):
+                return {'users': 0, 'samples': 0}
+            user_ids = [row[0] for row in conn.execute(f'''
+                SELECT user_id FROM {schema}.realtime_samples
+                UNION SELECT user_id FROM {schema}.realtime_blocks
+            ''')]
+            for user_id in user_ids:
+                rows = conn.execute(f'''
+                    SELECT s.ts, m.name, s.value
+                    FROM {schema}.realtime_samples s JOIN main.realtime_metrics m ON m.code = s.metric
+                    WHERE s.user_id = ?
+                ''', (user_id,)).fetchall()
+                rows += [(ts, name, value) for name, data in conn.execute(f'''
+                    SELECT m.name, b.data
+                    FROM {schema}.realtime_blocks b JOIN main.realtime_metrics m ON m.code = b.metric
+                    WHERE b.user_id = ?
+                ''', (user_id,)).fetchall() for ts, value in decode_sample_block(data)]
+                merged = {}
+                existing = self.lookup(conn, user_id, month)
+                if existing:
+                    merged.update(((ts, name), value) for ts, name, value in self.read(existing))
+                merged.update(((ts, name), value) for ts, name, value in rows)
+                path = self.relative_path(user_id, month)
+                size = self.write(path, [(ts, name, value) for (ts, name), value in sorted(merged.items())])
+                db_writer.run(lambda conn: upsert(
+                    conn.cursor(), 'realtime_archive_index', {'user_id': user_id, 'month': month},
+                    {'path': path, 'sample_count': len(merged), 'bytes': size}, touch_column='archived_at'
+                ).rowcount)
+                users += 1
+                samples += len(rows)
+        realtime_partitions.drop(month)
+        self.archived_files += users
+        self.archived_samples += samples
+        log_event(logging.INFO, 'archive.month', '实时数据月分区已归档', month=month, users=users, samples=samples)
+        return {'users': users, 'samples': samples}
+
+    def purge(self, cutoff_ts):
+        """删除整月都已过保留期的归档文件和索引，返回删除的文件数"""
+        with db_connection() as conn:
+            rows = conn.execute('SELECT user_id, month, path FROM realtime_archive_index WHERE month < ?',
+                                (partition_month(cutoff_ts),)).fetchall()
+        # 先删索引再删文件：读取方查不到索引就不会再去打开文件
+        db_writer.run(lambda conn: conn.executemany(
+            'DELETE FROM realtime_archive_index WHERE user_id = ? AND month = ?',
+            [(row['user_id'], row['month']) for row in rows]
+        ).rowcount)
+        for row in rows:
+            try:
+                os.remove(os.path.join(self.directory, row['path']))
+            except FileNotFoundError:
+                pass
+        for month in {row['month'] for row in rows}:
+            try:
+                os.rmdir(os.path.join(self.directory, month))
+            except OSError:
+                pass
+        return len(rows)
+
+    def snapshot(self):
+        return {
+            'hot_days': REALTIME_HOT_DAYS,
+            'archived_files': self.archived_files,
+            'archived_samples': self.archived_samples,
+            'cold_reads': self.cold_reads
+        }
+
+realtime_archive = RealtimeArchive()
+
+# ==================== 实时数据压缩块 ====================
+
+REALTIME_BLOCK_STORAGE = os.environ.get('REALTIME_BLOCK_STORAGE', '0').lower() in ('1', 'true', 'yes')
+REALTIME_BLOCK_BATCH = 200       # 压缩任务每个事务处理的块数
+
+class _BitWriter:
+    def __init__(self):
+        self.bits = 0
+        self.length = 0
+
+    def write(self, value, count):
+        self.bits = (self.bits << count) | (value & ((1 << count) - 1))
+        self.length += count
+
+    def to_bytes(self):
+        padding = -self.length % 8
+        return (self.bits << padding).to_bytes((self.length + padding) // 8, 'big')
+
+class _BitReader:
+    def __init__(self, data):
+        self.bits = int.from_bytes(data, 'big')
+        self.remaining = len(data) * 8
+
+    def read(self, count):
+        self.remaining -= count
+        return (self.bits >> self.remaining) & ((1 << count) - 1)
+
+    def read_signed(self, count):
+        value = self.read(count)
+        return value - (1 << count) if value >> (count - 1) else value
+
+# 时间戳二阶差分的分档：(前缀, 前缀位数, 数值位数)，相邻样本间隔不变时只占1位
+_DOD_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 32)]
+
+def _float_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+def encode_sample_block(samples):
+    """按 Gorilla 的方式压缩一段按时间升序的 (ts, value)：
+    时间戳存二阶差分，数值与上一个值按位异或后只存有效位。返回 bytes。
+    value 必须是数字，否则抛出 ValueError
+    """
+    if not all(is_numeric_value(value) for _, value in samples):
+        raise ValueError('压缩块只能包含数值样本')
+    writer = _BitWriter()
+    first_ts, first_value = samples[0]
+    writer.write(len(samples), 16)
+    writer.write(first_ts, 32)
+    writer.write(_float_bits(first_value), 64)
+
+    previous_ts, previous_delta = first_ts, None
+    previous_bits, window = _float_bits(first_value), None
+    for ts, value in samples[1:]:
+        delta = ts - previous_ts
+        if previous_delta is None:
+            writer.write(delta, 14)   # 一天内的第一个间隔不超过1440分钟
+        else:
+            dod = delta - previous_delta
+            if dod == 0:
+                writer.write(0, 1)
+            else:
+                for prefix, prefix_bits, value_bits in _DOD_BUCKETS:
+                    if -(1 << (value_bits - 1)) <= dod < (1 << (value_bits - 1)):
+                        writer.write(prefix, prefix_bits)
+                        writer.write(dod, value_bits)
+                        break
+        previous_ts, previous_delta = ts, delta
+
+        bits = _float_bits(value)
+        xor = bits ^ previous_bits
+        previous_bits = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if window and leading >= window[0] and trailing >= window[1]:
+            # 有效位落在上一个窗口内，沿用窗口
+            writer.write(0b10, 2)
+            writer.write(xor >> window[1], 64 - window[0] - window[1])
+        else:
+            window = (leading, trailing)
+            significant = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(significant - 1, 6)
+            writer.write(xor >> trailing, significant)
+    return writer.to_bytes()
+
+def decode_sample_block(data):
+    """encode_sample_block 的逆过程，返回按时间升序的 [(ts, value)]"""
+    reader = _BitReader(data)
+    count = reader.read(16)
+    ts = reader.read(32)
+    bits = reader.read(64)
+    samples = [(ts, struct.unpack('>d', struct.pack('>Q', bits))[0])]
+
+    delta, window = None, None
+    for _ in range(count - 1):
+        if delta is None:
+            delta = reader.read(14)
+        elif reader.read(1):
+            for _, prefix_bits, value_bits in _DOD_BUCKETS[:-1]:
+                if not reader.read(1):
+                    break
+            else:
+                value_bits = _DOD_BUCKETS[-1][2]
+            delta += reader.read_signed(value_bits)
+        ts += delta
+
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                significant = reader.read(6) + 1
+                window = (leading, 64 - leading - significant)
+            bits ^= reader.read(64 - window[0] - window[1]) << window[1]
+        samples.append((ts, struct.unpack('>d', struct.pack('>Q', bits))[0]))
+    return samples
+
+class RealtimeBlocks:
+    """可选的压缩块存储：已结束的日期把每个用户每种数据的逐行样本压成一个块
+    （分区内的 realtime_blocks 表，每天一行），长时间范围查询只需读取少量小块。
+
+    写入、旧数据搬迁等按行处理的逻辑在操作某天之前先把该天的块解回逐行存储，
+    因此汇总重算等SQL只需面对逐行数据；该天在下一次压缩任务中重新压缩。
+    """
+
+    def __init__(self):
+        self.blocks_written = 0
+        self.samples_compacted = 0
+        self.compressed_bytes = 0
+        self.blocks_expanded = 0
+
+    def expand(self, conn, schema, keys):
+        """把 (user_id, metric, day) 对应的块解回逐行存储，需在写事务中调用"""
+        for user_id, metric, day in keys:
+            row = conn.execute(
+                f'SELECT data FROM {schema}.realtime_blocks WHERE user_id = ? AND metric = ? AND day = ?',
+                (user_id, metric, day)
+            ).fetchone()
+            if row is None:
+                continue
+            conn.executemany(
+                f'INSERT OR IGNORE INTO {schema}.realtime_samples (user_id, metric, ts, value) VALUES (?, ?, ?, ?)',
+                [(user_id, metric, ts, value) for ts, value in decode_sample_block(row['data'])]
+            )
+            conn.execute(f'DELETE FROM {schema}.realtime_blocks WHERE user_id = ? AND metric = ? AND day = ?',
+                         (user_id, metric, day))
+            self.blocks_expanded += 1
+
+    def rows(self, conn, schema, user_id, ts_start, ts_end, metric=None):
+        """解码 [ts_start, ts_end) 涉及的块，返回与逐行查询格式相同、按时间倒序的行"""
+        query = f'''
+            SELECT m.name, b.data FROM {schema}.realtime_blocks b
+            JOIN main.realtime_metrics m ON m.code = b.metric
+            WHERE b.user_id = ? AND b.day >= ? AND b.day <= ?
+        '''
+        params = [user_id, ts_start // 1440, (ts_end - 1) // 1440]
+        if metric is not None:
+            query += ' AND b.metric = ?'
+            params.append(metric)
+        rows = []
+        for name, data in conn.execute(query, params).fetchall():
+            for ts, value in decode_sample_block(data):
+                if ts_start <= ts < ts_end:
+                    time_stamp = from_epoch_minute(ts)
+                    rows.append({'user_id': user_id, 'record_date': time_stamp[:10], 'time_stamp': time_stamp,
+                                 'data_type': name, 'value': value})
+        rows.sort(key=lambda row: row['time_stamp'], reverse=True)
+        return rows
+
+    def compact_month(self, month, before_ts):
+        """把分区中 before_ts 之前的逐行样本按 (用户, 数据类型, 天) 压成块，返回写入的块数。
+
+        待压缩的分组在连接池的连接上查出，每批作为一个写任务交给写线程
+        """
+        schema = RealtimePartitions.schema(month)
+        with db_connection() as conn:
+            if not realtime_partitions.attach(conn, [month]):
+                return 0
+            groups = conn.execute(f'''
+                SELECT DISTINCT user_id, metric, ts / 1440 AS day
+                FROM {schema}.realtime_samples WHERE ts < ? AND typeof(value) IN ('integer', 'real')
+            ''', (before_ts,)).fetchall()
+        upsert_sql = build_upsert_sql(f'{schema}.realtime_blocks', ('user_id', 'metric', 'day'),
+                                      ('sample_count', 'data'))
+
+        def compact(conn, batch):
+            if not realtime_partitions.attach(conn, [month]):
+                return 0
+            conn.execute('BEGIN IMMEDIATE')
+            count = 0
+            for user_id, metric, day in batch:
+                # 同一天已有的块（之前被解开后又补写的情况）与逐行样本合并，逐行样本优先
+                self.expand(conn, schema, [(user_id, metric, day)])
+                # 早期写入的非数值样本无法压缩，留在逐行存储中，不影响同一天其他样本
+                samples = conn.execute(f'''
+                    SELECT ts, value FROM {schema}.realtime_samples
+                    WHERE user_id = ? AND metric = ? AND ts >= ? AND ts < ?
+                      AND typeof(value) IN ('integer', 'real')
+                    ORDER BY ts
+                ''', (user_id, metric, day * 1440, day * 1440 + 1440)).fetchall()
+                if not samples:
+                    continue
+                data = encode_sample_block([tuple(sample) for sample in samples])
+                conn.execute(upsert_sql, (user_id, metric, day, len(samples), data))
+                conn.execute(f'''
+                    DELETE FROM {schema}.realtime_samples
+                    WHERE user_id = ? AND metric = ? AND ts >= ? AND ts < ?
+                      AND typeof(value) IN ('integer', 'real')
+                ''', (user_id, metric, day * 1440, day * 1440 + 1440))
+                count += 1
+                self.samples_compacted += len(samples)
+                self.compressed_bytes += len(data)
+            return count
+
+        written = 0
+        for start in range(0, len(groups), REALTIME_BLOCK_BATCH):
+            written += db_writer.run(compact, groups[start:start + REALTIME_BLOCK_BATCH])
+        self.blocks_written += written
+        return written
+
+    def snapshot(self):
+        return {
+            'enabled': REALTIME_BLOCK_STORAGE,
+            'blocks_written': self.blocks_written,
+            'samples_compacted': self.samples_compacted,
+            'compressed_bytes': self.compressed_bytes,
+            'blocks_expanded': self.blocks_expanded
+        }
+
+realtime_blocks = RealtimeBlocks()
+
+# ==================== 实时数据汇总 ====================
+
+REALTIME_ROLLUP_RESOLUTIONS = {'5m': 5, '1h': 60, '1d': 1440}   # 查询参数 -> 桶宽（分钟）
+REALTIME_MAX_POINTS = 800        # resolution=auto 时单条曲线最多返回的点数
+
+_ROLLUP_UPSERT_TAIL = '''
+    HAVING COUNT(*) > 0
+    ON CONFLICT (user_id, data_type, resolution, bucket_start) DO UPDATE SET
+        min_value = excluded.min_value,
+        max_value = excluded.max_value,
+        sum_value = excluded.sum_value,
+        sample_count = excluded.sample_count,
+        last_value = excluded.last_value,
+        last_time = excluded.last_time
+'''
+
+# 最细一级直接从原始数据重算，{samples} 为桶所在月份分区的样本表；早期写入的非数值样本不参与汇总
+_ROLLUP_FROM_RAW_SQL = '''
+    INSERT INTO main.realtime_rollups (user_id, data_type, resolution, bucket_start,
+                                       min_value, max_value, sum_value, sample_count, last_value, last_time)
+    SELECT :user_id, :data_type, :resolution, :bucket_start,
+           MIN(value), MAX(value), SUM(value), COUNT(*),
+           (SELECT value FROM {samples}
+            WHERE user_id = :user_id AND metric = :metric AND ts >= :ts_start AND ts < :ts_end
+              AND typeof(value) IN ('integer', 'real')
+            ORDER BY ts DESC LIMIT 1),
+           strftime('%Y-%m-%d %H:%M', MAX(ts) * 60, 'unixepoch')
+    FROM {samples}
+    WHERE user_id = :user_id AND metric = :metric AND ts >= :ts_start AND ts < :ts_end
+      AND typeof(value) IN ('integer', 'real')
+''' + _ROLLUP_UPSERT_TAIL
+
+# 更粗的级别从下一级汇总合并，只需读取几十行
+_ROLLUP_FROM_CHILD_SQL = '''
+    INSERT INTO realtime_rollups (user_id, data_type, resolution, bucket_start,
+                                  min_value, max_value, sum_value, sample_count, last_value, last_time)
+    SELECT :user_id, :data_type, :resolution, :bucket_start,
+           MIN(min_value), MAX(max_value), SUM(sum_value), SUM(sample_count),
+           (SELECT last_value FROM realtime_rollups
+            WHERE user_id = :user_id AND data_type = :data_type AND resolution = :child_resolution
+              AND bucket_start >= :bucket_start AND bucket_start < :bucket_end
+            ORDER BY last_time DESC LIMIT 1),
+           MAX(last_time)
+    FROM realtime_rollups
+    WHERE user_id = :user_id AND data_type = :data_type AND resolution = :child_resolution
+      AND bucket_start >= :bucket_start AND bucket_start < :bucket_end
+''' + _ROLLUP_UPSERT_TAIL
+
+def realtime_bucket_start(time_stamp, resolution):
+    """计算时间戳所在汇总桶的起点，兼容早期带秒的时间戳"""
+    moment = datetime.strptime(time_stamp[:16], '%Y-%m-%d %H:%M')
+    minutes = moment.hour * 60 + moment.minute
+    start = moment.replace(hour=0, minute=0) + timedelta(minutes=minutes - minutes % resolution)
+    return start.strftime('%Y-%m-%d %H:%M')
+
+def refresh_realtime_rollups(conn, samples):
+    """按受影响的桶逐级重算汇总：5分钟桶取原始数据，小时桶取5分钟桶，天桶取小时桶。
+
+    samples 为 (user_id, data_type, time_stamp) 的可迭代对象，需与写入原始数据处于同一事务；
+    调用前应已通过 metric_code 登记过这些数据类型，并挂载好样本所在的月份分区。
+    """
+    touched = set()
+    for user_id, data_type, time_stamp in samples:
+        try:
+            realtime_bucket_start(time_stamp, 1)
+        except (TypeError, ValueError):
+            continue
+        touched.add((user_id, data_type, time_stamp[:16]))
+    # 5分钟桶不会跨月，只需读取样本所在的分区；分区不存在说明桶内已无数据
+    months = set(realtime_partitions.attach(
+        conn, {partition_month(to_epoch_minute(time_stamp)) for _, _, time_stamp in touched}
+    ))
+
+    child_resolution = None
+    for resolution in sorted(REALTIME_ROLLUP_RESOLUTIONS.values()):
+        buckets = {(user_id, data_type, realtime_bucket_start(time_stamp, resolution))
+                   for user_id, data_type, time_stamp in touched}
+        for user_id, data_type, bucket_start in buckets:
+            bucket_end = (datetime.strptime(bucket_start, '%Y-%m-%d %H:%M')
+                          + timedelta(minutes=resolution)).strftime('%Y-%m-%d %H:%M')
+            params = {
+                'user_id': user_id, 'data_type': data_type, 'resolution': resolution,
+                'child_resolution': child_resolution,
+                'bucket_start': bucket_start, 'bucket_end': bucket_end,
+                'metric': metric_code(data_type),
+                'ts_start': to_epoch_minute(bucket_start), 'ts_end': to_epoch_minute(bucket_end)
+            }
+            if child_resolution is not None:
+                affected = conn.execute(_ROLLUP_FROM_CHILD_SQL, params).rowcount
+            elif partition_month(params['ts_start']) in months:
+                samples_table = f"{RealtimePartitions.schema(partition_month(params['ts_start']))}.realtime_samples"
+                affected = conn.execute(_ROLLUP_FROM_RAW_SQL.format(samples=samples_table), params).rowcount
+            else:
+                affected = 0
+            if affected == 0:
+                # 桶内已无数据，删除旧的汇总
+                conn.execute('''
+                    DELETE FROM realtime_rollups
+                    WHERE user_id = ? AND data_type = ? AND resolution = ? AND bucket_start = ?
+                ''', (user_id, data_type, resolution, bucket_start))
+        child_resolution = resolution
+
+def choose_realtime_resolution(days):
+    """选择能放进点数预算的最细粒度：按每分钟一条估算原始数据量"""
+    span_minutes = days * 1440
+    if span_minutes <= REALTIME_MAX_POINTS:
+        return 'raw'
+    for name, minutes in sorted(REALTIME_ROLLUP_RESOLUTIONS.items(), key=lambda item: item[1]):
+        if span_minutes // minutes <= REALTIME_MAX_POINTS:
+            return name
+    return '1d'
+
+class RankingBoard:
+    """有序排行榜：按 (-分数, 次序键, 成员ID) 维护有序列表。
+    取前k名为切片 O(k)，查询某个成员的名次为二分查找 O(log n)"""
+
+    def __init__(self):
+        self._entries = []     # 有序的 (-score, tie_key, member_id)
+        self._by_member = {}   # member_id -> entry
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, member_id):
+        return member_id in self._by_member
+
+    def _discard(self, member_id):
+        entry = self._by_member.pop(member_id, None)
+        if entry is not None:
+            del self._entries[bisect_left(self._entries, entry)]
+        return entry
+
+    def update(self, member_id, score, tie_key=None):
+        """设置成员分数；tie_key为None时沿用原来的次序键"""
+        with self._lock:
+            old = self._discard(member_id)
+            if tie_key is None:
+                tie_key = old[1] if old else ''
+            entry = (-score, tie_key, member_id)
+            insort(self._entries, entry)
+            self._by_member[member_id] = entry
+
+    def set_tie_key(self, member_id, tie_key):
+        with self._lock:
+            old = self._by_member.get(member_id)
+        if old is not None:
+            self.update(member_id, -old[0], tie_key)
+
+    def remove(self, member_id):
+        with self._lock:
+            self._discard(member_id)
+
+    def top(self, limit, offset=0):
+        """返回 [(名次, 成员ID, 分数, 次序键)]"""
+        with self._lock:
+            page = self._entries[offset:offset + limit]
+        return [(offset + i + 1, member_id, -neg_score, tie_key)
+                for i, (neg_score, tie_key, member_id) in enumerate(page)]
+
+    def after(self, score, tie_key, member_id, limit):
+        """游标分页：返回排在 (score, tie_key, member_id) 之后的 limit 名"""
+        with self._lock:
+            start = bisect_right(self._entries, (-score, tie_key, member_id))
+            page = self._entries[start:start + limit]
+        return [(start + i + 1, member_id, -neg_score, tie_key)
+                for i, (neg_score, tie_key, member_id) in enumerate(page)]
+
+    def rank_of(self, member_id):
+        """返回 (名次, 分数)，成员不在榜上时返回None"""
+        with self._lock:
+            entry = self._by_member.get(member_id)
+            if entry is None:
+                return None
+            return bisect_left(self._entries, entry) + 1, -entry[0]
+
+class StepsLeaderboard:
+    """按日期缓存的步数排行榜：首次访问某天时从数据库加载一次，之后由各写入接口增量更新。
+    与原排行榜一致，所有用户都在榜上（没有记录按0步），同步数按用户名排序"""
+
+    def __init__(self, max_dates=7):
+        self.max_dates = max_dates
+        self._boards = OrderedDict()   # record_date -> RankingBoard
+        self._lock = threading.Lock()
+
+    def _load(self, record_date):
+        board = RankingBoard()
+        with db_connection() as conn:
+            rows = conn.execute('''
+                SELECT u.id, u.username, COALESCE(h.steps, 0) as steps
+                FROM users u
+                LEFT JOIN health_data h ON u.id = h.user_id AND h.record_date = ?
+            ''', (record_date,)).fetchall()
+        for row in rows:
+            board.update(row['id'], row['steps'] or 0, row['username'])
+        return board
+
+    def board(self, record_date):
+        # 加载与增量更新共用一把锁：加载期间提交的写入会在加载完成后再应用，不会丢失
+        with self._lock:
+            board = self._boards.get(record_date)
+            if board is None:
+                board = self._load(record_date)
+                self._boards[record_date] = board
+                while len(self._boards) > self.max_dates:
+                    self._boards.popitem(last=False)
+            else:
+                self._boards.move_to_end(record_date)
+            return board
+
+    def record_steps(self, user_id, record_date, steps):
+        """写入提交后调用；只更新已加载的日期"""
+        with self._lock:
+            board = self._boards.get(record_date)
+            if board is None:
+                return
+            if user_id in board:
+                board.update(user_id, steps or 0)
+            else:
+                # 榜上没有该用户（如加载后新注册），下次访问时重新加载
+                del self._boards[record_date]
+
+    def add_user(self, user_id, username):
+        with self._lock:
+            for board in self._boards.values():
+                board.update(user_id, 0, username)
+
+    def rename_user(self, user_id, username):
+        with self._lock:
+            for board in self._boards.values():
+                board.set_tie_key(user_id, username)
+
+steps_leaderboard = StepsLeaderboard()
+
+def parse_steps(value):
+    """步数统一为非负整数，无法转换时抛出 ValueError"""
+    if isinstance(value, bool):
+        raise ValueError('步数格式错误')
+    steps = int(value)
+    if steps < 0:
+        raise ValueError('步数不能为负数')
+    return steps
+
+def merge_health_data(conn, user_id, record_date, values):
+    """写任务：合并当天的健康数据字段；包含步数时在提交后更新步数排行榜"""
+    upsert(
+        conn.cursor(), 'health_data',
+        {'user_id': user_id, 'record_date': record_date}, values,
+        touch_column='updated_at'
+    )
+    if 'steps' in values:
+        db_writer.after_commit(steps_leaderboard.record_steps, user_id, record_date, values['steps'])
+
+class PointsLeaderboard:
+    """总积分排行榜：启动时从user_points重建一次，之后由积分写入接口增量更新。
+    同分按用户ID排序，保证分页稳定"""
+
+    def __init__(self):
+        self._board = None
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        board = RankingBoard()
+        with self._lock:
+            with db_connection() as conn:
+                rows = conn.execute('SELECT user_id, total_points FROM user_points').fetchall()
+            for row in rows:
+                board.update(row['user_id'], row['total_points'] or 0, row['user_id'])
+            self._board = board
+        return board
+
+    @property
+    def board(self):
+        return self._board if self._board is not None else self.rebuild()
+
+    def set_points(self, user_id, total_points):
+        """在写线程中提交后调用（DatabaseWriter.after_commit），total_points为最新总积分"""
+        with self._lock:
+            if self._board is not None:
+                self._board.update(user_id, total_points, user_id)
+
+points_leaderboard = PointsLeaderboard()
+
+class DataVersions:
+    """每个用户 health_data 的内存版本号，写入提交后递增，用于生成 ETag。
+
+    版本号只保存在本进程内，重启后从0重新计数，因此 ETag 中带上启动ID，避免旧标签误命中。
+    """
+    
+    def __init__(self):
+        self.boot_id = f'{int(time.time()):x}{os.getpid():x}'
+        self._versions = {}
+        self._lock = threading.Lock()
+    
+    def get(self, user_id):
+        return self._versions.get(user_id, 0)
+    
+    def bump(self, user_id):
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+    
+    def etag(self, user_id, *parts):
+        return '-'.join([self.boot_id, str(self.get(user_id)), *map(str, parts)])
+
+health_data_versions = DataVersions()
+
+def health_data_etag(view):
+    """按用户 health_data 版本号做条件GET：If-None-Match 命中时直接返回304，不执行查询。
+
+    标签里带上当天日期，跨天后“今日/最近7天”的结果会变化；版本号需在查询之前读取。
+    """
+    @wraps(view)
+    def wrapper(user_id, *args, **kwargs):
+        etag = health_data_versions.etag(user_id, datetime.now().strftime('%Y-%m-%d'))
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = view(user_id, *args, **kwargs)
+            if not isinstance(response, Response) or response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+# 密码哈希进程池配置：bcrypt是纯CPU计算，放到独立进程中执行，避免占满请求线程
+PASSWORD_HASH_WORKERS = min(4, os.cpu_count() or 1)
+PASSWORD_HASH_MAX_PENDING = 32     # 排队+执行中的任务上限，超出后直接返回繁忙
+PASSWORD_HASH_TIMEOUT = 10         # 单次哈希最长等待时间（秒）
+
+# bcrypt工作因子按部署机器自动校准：启动时选出单次哈希不超过目标耗时的最大cost，
+# 但不低于 bcrypt 默认的12，机器再慢也不降低已有哈希的强度。
+# 常见CPU上cost 12约需150~300ms，默认目标需高于这个耗时，快机器上才会真正提高cost
+BCRYPT_TARGET_MS = float(os.environ.get('BCRYPT_TARGET_MS', 250))
+BCRYPT_MIN_ROUNDS = 12
+BCRYPT_MAX_ROUNDS = 16
+
+class PasswordHashBusy(Exception):
+    """密码哈希任务过多或等待超时，拒绝新任务"""
+
+def _bcrypt_hash(password, rounds=None):
+    salt = bcrypt.gensalt(rounds) if rounds else bcrypt.gensalt()
+    return bcrypt.hashpw(password, salt)
+
+def bcrypt_rounds_of(password_hash):
+    """从 $2b$12$... 形式的哈希中取出cost"""
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode('utf-8')
+    try:
+        return int(password_hash.split(b'$')[2])
+    except (IndexError, ValueError):
+        return None
+
+def calibrate_bcrypt_rounds(target_ms=BCRYPT_TARGET_MS):
+    """逐级增加cost测量耗时（cost每加1耗时翻倍），返回不超过目标耗时的最大cost，最低为 BCRYPT_MIN_ROUNDS"""
+    sample = b'calibration-password'
+    rounds = BCRYPT_MIN_ROUNDS
+    start = time.perf_counter()
+    bcrypt.hashpw(sample, bcrypt.gensalt(rounds))
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if elapsed_ms > target_ms:
+        log_event(logging.WARNING, 'auth.bcrypt_floor', 'bcrypt最低cost已超过目标耗时，按下限使用',
+                  rounds=rounds, elapsed_ms=round(elapsed_ms, 2), target_ms=target_ms)
+        return rounds
+    while rounds < BCRYPT_MAX_ROUNDS:
+        start = time.perf_counter()
+        bcrypt.hashpw(sample, bcrypt.gensalt(rounds + 1))
+        if (time.perf_counter() - start) * 1000 > target_ms:
+            break
+        rounds += 1
+    return rounds
+
+def _bcrypt_check(password, password_hash):
+    return bcrypt.checkpw(password, password_hash)
+
+class PasswordHasher:
+    """在有界进程池中执行bcrypt，并记录耗时和队列长度"""
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = None          # 校准前使用bcrypt默认cost
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._metrics_lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._failed = 0
+        self._total_ms = 0.0
+        self._max_ms = 0.0
+        self._recent_ms = deque(maxlen=256)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                # 使用spawn启动子进程，避免在多线程服务进程中fork
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def _reset_executor(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._metrics_lock:
+                self._rejected += 1
+            raise PasswordHashBusy('密码哈希队列已满')
+        
+        with self._metrics_lock:
+            self._pending += 1
+        start = time.perf_counter()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._release()
+            with self._metrics_lock:
+                self._failed += 1
+            raise
+        # 名额在任务真正结束（完成、取消或进程池损坏）时才归还，
+        # 超时返回的请求不会让仍在队列中的任务绕过排队上限
+        future.add_done_callback(self._release)
+
+        succeeded = False
+        try:
+            result = future.result(timeout=PASSWORD_HASH_TIMEOUT)
+            succeeded = True
+            return result
+        except FutureTimeoutError:
+            future.cancel()
+            raise PasswordHashBusy('密码哈希等待超时')
+        except BrokenProcessPool:
+            self._reset_executor()
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._metrics_lock:
+                if succeeded:
+                    self._completed += 1
+                    self._total_ms += elapsed_ms
+                    self._max_ms = max(self._max_ms, elapsed_ms)
+                    self._recent_ms.append(elapsed_ms)
+                else:
+                    self._failed += 1
+
+    def _release(self, future=None):
+        with self._metrics_lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def calibrate(self, target_ms=BCRYPT_TARGET_MS):
+        self.rounds = calibrate_bcrypt_rounds(target_ms)
+        return self.rounds
+
+    def hash(self, password):
+        return self._run(_bcrypt_hash, password.encode('utf-8'), self.rounds)
+
+    def needs_rehash(self, password_hash):
+        """已存储哈希的cost低于当前校准值时需要重新哈希，cost更高的哈希保持不变"""
+        if self.rounds is None:
+            return False
+        rounds = bcrypt_rounds_of(password_hash)
+        return rounds is not None and rounds < self.rounds
+
+    def check(self, password, password_hash):
+        return self._run(_bcrypt_check, password.encode('utf-8'), password_hash)
+
+    def snapshot(self):
+        with self._metrics_lock:
+            recent = sorted(self._recent_ms)
+            return {
+                'bcrypt_rounds': self.rounds,
+                'bcrypt_target_ms': BCRYPT_TARGET_MS,
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'queue_length': self._pending,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'failed': self._failed,
+                'avg_ms': round(self._total_ms / self._completed, 2) if self._completed else 0,
+                'max_ms': round(self._max_ms, 2),
+                'p95_ms': round(recent[math.ceil(len(recent) * 0.95) - 1], 2) if recent else 0
+            }
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+password_hasher = PasswordHasher()
+atexit.register(password_hasher.shutdown)
+
+AVATAR_FOLDER = os.path.join('static', 'avatars')
+AVATAR_URL_PREFIX = '/static/avatars/'
+AVATAR_THUMBNAIL_SIZES = {'small': 64, 'medium': 256}   # 缩略图名称 -> 最长边像素
+AVATAR_THUMBNAIL_QUEUE_SIZE = 256
+AVATAR_MAX_BYTES = 5 * 1024 * 1024     # 单张头像大小上限
+AVATAR_CHUNK_SIZE = 64 * 1024          # 流式上传时每次读取的字节数
+
+class AvatarTooLarge(Exception):
+    """头像超过 AVATAR_MAX_BYTES"""
+
+# 按文件头识别图片格式，识别不出的按jpg保存
+_IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+def image_extension(head):
+    for signature, extension in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return 'jpg'
+
+def avatar_thumbnail_path(digest, size):
+    return os.path.join(AVATAR_FOLDER, f'{digest}_{size}.jpg')
+
+def avatar_digest(avatar_url):
+    """从按内容哈希命名的头像URL中取出哈希值，旧的时间戳命名返回None"""
+    if not avatar_url or not avatar_url.startswith(AVATAR_URL_PREFIX):
+        return None
+    name = os.path.splitext(avatar_url[len(AVATAR_URL_PREFIX):])[0]
+    if len(name) == 64 and all(ch in '0123456789abcdef' for ch in name):
+        return name
+    return None
+
+def avatar_thumbnail_url(avatar_url, size='small'):
+    """缩略图已生成时返回缩略图URL，否则退回原图URL"""
+    digest = avatar_digest(avatar_url)
+    if digest and os.path.exists(avatar_thumbnail_path(digest, size)):
+        return f'{AVATAR_URL_PREFIX}{digest}_{size}.jpg'
+    return avatar_url or ''
+
+def store_avatar(chunks):
+    """分块写入临时文件并同时计算sha256，返回 (访问URL, 临时文件路径)，由 publish_avatar 改名为正式文件。
+
+    同一张图片只保存一份；累计超过 AVATAR_MAX_BYTES 时立即停止读取并抛出 AvatarTooLarge，
+    内容为空时返回None
+    """
+    os.makedirs(AVATAR_FOLDER, exist_ok=True)
+    hasher = hashlib.sha256()
+    head = b''
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=AVATAR_FOLDER, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > AVATAR_MAX_BYTES:
+                    raise AvatarTooLarge()
+                if len(head) < 16:
+                    head += chunk[:16 - len(head)]
+                hasher.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            os.remove(temp_path)
+            return None
+        filename = f'{hasher.hexdigest()}.{image_extension(head)}'
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return AVATAR_URL_PREFIX + filename, temp_path
+
+def publish_avatar(avatar_url, temp_path):
+    """写任务：把临时文件改名为正式头像文件，同内容的文件已存在时丢弃临时文件。
+
+    文件的发布和孤儿文件的删除都在写线程中进行，与引用它们的 UPDATE 串行，
+    复用已有文件的上传不会与删除该文件的清理交错
+    """
+    filename = os.path.basename(avatar_url)
+    file_path = os.path.join(AVATAR_FOLDER, filename)
+    if os.path.exists(file_path):
+        os.remove(temp_path)
+    else:
+        # 同目录内改名是原子的，读取方不会读到半个文件
+        os.replace(temp_path, file_path)
+        log_event(logging.DEBUG, 'avatar.stored', '保存新头像文件', filename=filename)
+    db_writer.after_commit(avatar_thumbnailer.submit, avatar_digest(avatar_url), file_path)
+
+def orphan_avatar_paths(conn, avatar_url):
+    """头像URL不再被任何用户引用时返回原图和缩略图的路径，仍被引用时返回空列表"""
+    if not avatar_url or not avatar_url.startswith(AVATAR_URL_PREFIX):
+        return []
+    if conn.execute('SELECT 1 FROM users WHERE avatar_url = ? LIMIT 1', (avatar_url,)).fetchone():
+        return []
+    paths = [os.path.join(AVATAR_FOLDER, os.path.basename(avatar_url))]
+    digest = avatar_digest(avatar_url)
+    if digest:
+        paths += [avatar_thumbnail_path(digest, size) for size in AVATAR_THUMBNAIL_SIZES]
+    return paths
+
+def remove_avatar_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    log_event(logging.INFO, 'avatar.orphan_removed', '删除不再使用的头像文件', filename=os.path.basename(paths[0]))
+
+class AvatarThumbnailer:
+    """后台线程生成头像缩略图，上传接口只负责入队。
+
+    依赖Pillow；未安装时不生成缩略图，客户端继续使用原图
+    """
+
+    def __init__(self, queue_size=AVATAR_THUMBNAIL_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.generated = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def submit(self, digest, path):
+        if not self.available:
+            return
+        if all(os.path.exists(avatar_thumbnail_path(digest, size)) for size in AVATAR_THUMBNAIL_SIZES):
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((digest, path))
+        except queue.Full:
+            # 队列满时放弃本次缩略图，不影响上传结果
+            self.dropped += 1
+            log_event(logging.WARNING, 'avatar.thumbnail_dropped', '缩略图队列已满', digest=digest)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='avatar-thumbnails', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            digest, path = self._queue.get()
+            try:
+                self.generate(digest, path)
+                self.generated += 1
+            except Exception as e:
+                self.failed += 1
+                log_event(logging.WARNING, 'avatar.thumbnail_error', '生成缩略图失败', digest=digest, error=str(e))
+            finally:
+                self._queue.task_done()
+
+    def generate(self, digest, path):
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+            for size_name, max_side in AVATAR_THUMBNAIL_SIZES.items():
+                target = avatar_thumbnail_path(digest, size_name)
+                if os.path.exists(target):
+                    continue
+                thumbnail = image.copy()
+                thumbnail.thumbnail((max_side, max_side))
+                temp_path = f'{target}.tmp'
+                thumbnail.save(temp_path, 'JPEG', quality=85)
+                os.replace(temp_path, target)
+        if not os.path.exists(path):
+            # 生成期间原图已被当作孤立文件删除，缩略图也一并清理
+            for size_name in AVATAR_THUMBNAIL_SIZES:
+                try:
+                    os.remove(avatar_thumbnail_path(digest, size_name))
+                except FileNotFoundError:
+                    pass
+
+    def snapshot(self):
+        return {
+            'available': self.available,
+            'queue_length': self._queue.qsize(),
+            'generated': self.generated,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
+
+avatar_thumbnailer = AvatarThumbnailer()
+
 @app.route('/api/register', methods=['POST'])
 def register():
     try:
@@ -159,7 +2503,7 @@ def register():
         username = data.get('username', '').strip()
         password = data.get('password', '').strip()
         
-        print(f"[{datetime.now()}] 注册请求: 手机号={phone}, 用户名={username}")
+        log_event(logging.INFO, 'register.request', '注册请求', phone=phone, username=username)
         
         # 参数验证
         if not phone or not username or not password:
@@ -187,46 +2531,44 @@ def register():
             }), 400
         
         # 密码加密
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        password_hash = password_hasher.hash(password)
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def create_user(conn):
+            cursor = conn.cursor()
         
-        # 检查手机号是否已存在
-        existing_phone = cursor.execute(
-            'SELECT id FROM users WHERE phone = ?', (phone,)
-        ).fetchone()
+            # 检查手机号是否已存在
+            existing_phone = cursor.execute(
+                'SELECT id FROM users WHERE phone = ?', (phone,)
+            ).fetchone()
         
-        if existing_phone:
-            conn.close()
-            return jsonify({
-                'success': False,
-                'message': '该手机号已被注册'
-            }), 400
+            if existing_phone:
+                return None, '该手机号已被注册'
+        
+            # 检查用户名是否已存在
+            existing_username = cursor.execute(
+                'SELECT id FROM users WHERE username = ?', (username,)
+            ).fetchone()
         
-        # 检查用户名是否已存在
-        existing_username = cursor.execute(
-            'SELECT id FROM users WHERE username = ?', (username,)
-        ).fetchone()
+            if existing_username:
+                return None, '该用户名已被使用'
         
-        if existing_username:
-            conn.close()
+            # 插入新用户
+            cursor.execute(
+                'INSERT INTO users (phone, username, password_hash) VALUES (?, ?, ?)',
+                (phone, username, password_hash)
+            )
+            db_writer.after_commit(steps_leaderboard.add_user, cursor.lastrowid, username)
+            return cursor.lastrowid, None
+        
+        # 查重与插入在写线程的同一个事务中执行
+        user_id, error = db_writer.run(create_user)
+        if error:
             return jsonify({
                 'success': False,
-                'message': '该用户名已被使用'
+                'message': error
             }), 400
         
-        # 插入新用户
-        cursor.execute(
-            'INSERT INTO users (phone, username, password_hash) VALUES (?, ?, ?)',
-            (phone, username, password_hash)
-        )
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        print(f"[{datetime.now()}] 注册成功: ID={user_id}, 用户名={username}")
+        log_event(logging.INFO, 'register.success', '注册成功', user_id=user_id, username=username)
         
         return jsonify({
             'success': True,
@@ -236,8 +2578,13 @@ def register():
             'phone': phone
         })
         
+    except (PasswordHashBusy, DatabaseWriteBusy):
+        return jsonify({
+            'success': False,
+            'message': '服务器繁忙，请稍后重试'
+        }), 503
     except Exception as e:
-        print(f"[{datetime.now()}] 注册异常: {e}")
+        log_event(logging.ERROR, 'register.error', '注册异常', error=str(e))
         return jsonify({
             'success': False,
             'message': f'注册失败: {str(e)}'
@@ -252,32 +2599,29 @@ def add_points():
         source_type = data.get('source_type', 'manual')
         source_data = data.get('source_data', '')
         
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M')
-        print(f"[{current_time}] 添加积分: 用户{user_id}, 积分{points}")
+        try:
+            # 排行榜以整数ID为键，"2" 与 2 必须是同一个用户
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': '参数格式错误'}), 400
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        log_event(logging.INFO, 'points.add', '添加积分', user_id=user_id, points=points)
         
-        # 更新总积分
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_points (user_id, total_points, updated_at)
-            VALUES (?, COALESCE((SELECT total_points FROM user_points WHERE user_id = ?), 0) + ?, CURRENT_TIMESTAMP)
-        ''', (user_id, user_id, points))
+        def apply_points(conn):
+            cursor = conn.cursor()
         
-        # 记录积分历史
-        cursor.execute('''
-            INSERT INTO points_history (user_id, points, source_type, source_data, record_date)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, points, source_type, source_data, datetime.now().strftime('%Y-%m-%d')))
+            # 更新总积分
+            total_points = increment_user_points(cursor, user_id, points)
         
-        # 获取最新总积分
-        total_points_row = cursor.execute('''
-            SELECT total_points FROM user_points WHERE user_id = ?
-        ''', (user_id,)).fetchone()
-        total_points = total_points_row['total_points'] if total_points_row else 0
+            # 记录积分历史
+            cursor.execute('''
+                INSERT INTO points_history (user_id, points, source_type, source_data, record_date)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, points, source_type, source_data, datetime.now().strftime('%Y-%m-%d')))
+            db_writer.after_commit(points_leaderboard.set_points, user_id, total_points)
+            return total_points
         
-        conn.commit()
-        conn.close()
+        total_points = db_writer.run(apply_points)
         
         return jsonify({
             'success': True,
@@ -285,38 +2629,89 @@ def add_points():
             'total_points': total_points
         })
         
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M')
-        print(f"[{current_time}] 添加积分异常: {e}")
+        log_event(logging.ERROR, 'points.error', '添加积分异常', error=str(e))
         return jsonify({'success': False, 'message': f'添加失败: {str(e)}'}), 500
 
 @app.route('/api/points-ranking', methods=['GET'])
 def get_points_ranking():
+    """积分排行榜，支持 offset 分页或 cursor 游标分页（cursor取上一页返回的next_cursor）"""
     try:
-        limit = int(request.args.get('limit', 100))
-        
-        conn = get_db_connection()
-        
-        rankings = conn.execute('''
-            SELECT up.user_id, up.total_points, u.username 
-            FROM user_points up
-            JOIN users u ON up.user_id = u.id
-            ORDER BY up.total_points DESC
-            LIMIT ?
-        ''', (limit,)).fetchall()
-        
-        conn.close()
+        try:
+            limit = int(request.args.get('limit', 100))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return jsonify({'success': False, 'message': '参数格式错误'}), 400
+        if limit < 1 or offset < 0:
+            return jsonify({'success': False, 'message': 'limit需大于0，offset不能为负数'}), 400
+        cursor = request.args.get('cursor')
+        
+        board = points_leaderboard.board
+        if cursor:
+            try:
+                cursor_points, cursor_user_id = (int(part) for part in cursor.split(':'))
+            except ValueError:
+                return jsonify({'success': False, 'message': '游标格式错误'}), 400
+            page = board.after(cursor_points, cursor_user_id, cursor_user_id, limit)
+        else:
+            page = board.top(limit, offset)
+        
+        # 只为当前页的用户查询用户名
+        usernames = {}
+        if page:
+            user_ids = [user_id for _, user_id, _, _ in page]
+            with db_connection() as conn:
+                rows = conn.execute(
+                    f"SELECT id, username FROM users WHERE id IN ({', '.join('?' * len(user_ids))})",
+                    user_ids
+                ).fetchall()
+            usernames = {row['id']: row['username'] for row in rows}
         
         result = []
-        for i, row in enumerate(rankings):
+        for rank, user_id, total_points, _ in page:
+            if user_id not in usernames:
+                continue
             result.append({
-                'rank': i + 1,
-                'user_id': row['user_id'],
-                'username': row['username'],
-                'total_points': row['total_points']
+                'rank': rank,
+                'user_id': user_id,
+                'username': usernames[user_id],
+                'total_points': total_points
             })
         
-        return jsonify({'success': True, 'rankings': result})
+        next_cursor = None
+        if len(page) == limit:
+            _, last_user_id, last_points, _ = page[-1]
+            next_cursor = f"{last_points}:{last_user_id}"
+        
+        return jsonify({
+            'success': True,
+            'rankings': result,
+            'total': len(board),
+            'next_cursor': next_cursor
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
+
+@app.route('/api/points-rank/<int:user_id>', methods=['GET'])
+def get_points_rank(user_id):
+    """查询某个用户的积分名次，无需对全表排序"""
+    try:
+        board = points_leaderboard.board
+        rank_info = board.rank_of(user_id)
+        rank, total_points = rank_info if rank_info else (None, 0)
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'user_id': user_id,
+                'rank': rank,
+                'total_points': total_points,
+                'total': len(board)
+            }
+        })
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
@@ -340,41 +2735,48 @@ def reset_password():
                 'message': '密码长度不能少于6位'
             }), 400
         
-        new_password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        new_password_hash = password_hasher.hash(new_password)
         
-        user = cursor.execute(
-            'SELECT id FROM users WHERE username = ?', (username,)
-        ).fetchone()
+        updated = db_writer.run(lambda conn: conn.execute(
+            'UPDATE users SET password_hash = ? WHERE username = ?',
+            (new_password_hash, username)
+        ).rowcount)
         
-        if not user:
-            conn.close()
+        if not updated:
             return jsonify({
                 'success': False,
                 'message': '用户名不存在'
             }), 404
         
-        cursor.execute(
-            'UPDATE users SET password_hash = ? WHERE username = ?',
-            (new_password_hash, username)
-        )
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({
             'success': True,
             'message': '密码重置成功'
         })
         
+    except (PasswordHashBusy, DatabaseWriteBusy):
+        return jsonify({
+            'success': False,
+            'message': '服务器繁忙，请稍后重试'
+        }), 503
     except Exception as e:
         return jsonify({
             'success': False,
             'message': f'重置密码失败: {str(e)}'
         }), 500
 
+def rehash_password(user_id, password, old_password_hash):
+    """登录成功后按当前cost重新哈希密码；失败不影响本次登录"""
+    try:
+        new_password_hash = password_hasher.hash(password)
+        # 只在密码未被并发修改时替换
+        db_writer.run(lambda conn: conn.execute(
+            'UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+            (new_password_hash, user_id, old_password_hash)
+        ).rowcount)
+        log_event(logging.INFO, 'auth.rehashed', '密码哈希已升级', user_id=user_id, rounds=password_hasher.rounds)
+    except Exception as e:
+        log_event(logging.WARNING, 'auth.rehash_failed', '密码哈希升级失败', user_id=user_id, error=str(e))
+
 @app.route('/api/login', methods=['POST'])
 def login():
     try:
@@ -382,7 +2784,7 @@ def login():
         login_field = data.get('login_field', '').strip()
         password = data.get('password', '').strip()
         
-        print(f"[{datetime.now()}] 登录请求: {login_field}")
+        log_event(logging.INFO, 'login.request', '登录请求', login_field=login_field)
         
         if not login_field or not password:
             return jsonify({
@@ -390,22 +2792,22 @@ def login():
                 'message': '登录信息不能为空'
             }), 400
         
-        conn = get_db_connection()
-        
-        # 判断是手机号还是用户名
-        if validate_phone(login_field):
-            user = conn.execute(
-                'SELECT * FROM users WHERE phone = ?', (login_field,)
-            ).fetchone()
-        else:
-            user = conn.execute(
-                'SELECT * FROM users WHERE username = ?', (login_field,)
-            ).fetchone()
-        
-        conn.close()
-        
-        if user and bcrypt.checkpw(password.encode('utf-8'), user['password_hash']):
-            print(f"[{datetime.now()}] 登录成功: ID={user['id']}, 用户名={user['username']}")
+        with db_connection() as conn:
+            # 判断是手机号还是用户名
+            if validate_phone(login_field):
+                user = conn.execute(
+                    'SELECT * FROM users WHERE phone = ?', (login_field,)
+                ).fetchone()
+            else:
+                user = conn.execute(
+                    'SELECT * FROM users WHERE username = ?', (login_field,)
+                ).fetchone()
+        
+        if user and password_hasher.check(password, user['password_hash']):
+            log_event(logging.INFO, 'login.success', '登录成功', user_id=user['id'], username=user['username'])
+            
+            if password_hasher.needs_rehash(user['password_hash']):
+                rehash_password(user['id'], password, user['password_hash'])
             
             return jsonify({
                 'success': True,
@@ -416,14 +2818,19 @@ def login():
                 'avatar_path': ''  # 暂时为空，后续可添加头像功能
             })
         else:
-            print(f"[{datetime.now()}] 登录失败: {login_field}")
+            log_event(logging.INFO, 'login.failed', '登录失败', login_field=login_field)
             return jsonify({
                 'success': False,
                 'message': '手机号/用户名或密码错误'
             }), 401
             
+    except PasswordHashBusy:
+        return jsonify({
+            'success': False,
+            'message': '服务器繁忙，请稍后重试'
+        }), 503
     except Exception as e:
-        print(f"[{datetime.now()}] 登录异常: {e}")
+        log_event(logging.ERROR, 'login.error', '登录异常', error=str(e))
         return jsonify({
             'success': False,
             'message': f'登录失败: {str(e)}'
@@ -436,9 +2843,8 @@ def get_user_id_by_name():
         if not username:
             return jsonify({'success': False, 'message': '用户名不能为空'}), 400
         
-        conn = get_db_connection()
-        user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        with db_connection() as conn:
+            user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
         
         if user:
             return jsonify({'success': True, 'user_id': user['id']})
@@ -447,22 +2853,67 @@ def get_user_id_by_name():
     except Exception as e:
         return jsonify({'success': False, 'message': f'查询失败: {str(e)}'}), 500
 
+ALL_USERS_PAGE_SIZE = 50
+ALL_USERS_MAX_PAGE_SIZE = 200
+
+def prefix_upper_bound(prefix):
+    """前缀查询的上界：最后一个字符加一，prefix <= x < 上界 即以 prefix 开头，可以走索引"""
+    return prefix[:-1] + chr(min(ord(prefix[-1]) + 1, sys.maxunicode))
+
 # 获取所有用户（用于雷达加好友）
 @app.route('/api/all-users/<int:current_user_id>', methods=['GET'])
 def get_all_users(current_user_id):
+    """按 (username, id) 游标分页，q 为用户名前缀搜索；cursor 取上一页返回的 next_cursor。
+    传了 limit 或 cursor 才分页，都不传时返回全部用户（旧客户端不带分页参数）。
+
+    username 上的唯一索引本身按 (username, rowid) 排序，分页和前缀搜索都直接走该索引
+    """
     try:
-        conn = get_db_connection()
+        limit = None
+        if 'limit' in request.args or 'cursor' in request.args:
+            try:
+                limit = int(request.args.get('limit', ALL_USERS_PAGE_SIZE))
+            except ValueError:
+                return jsonify({'success': False, 'message': '参数格式错误'}), 400
+            limit = min(max(limit, 1), ALL_USERS_MAX_PAGE_SIZE)
+        prefix = request.args.get('q', '').strip()
+        cursor = request.args.get('cursor')
         
-        users = conn.execute('''
+        query = '''
             SELECT u.id, u.username, u.phone, u.avatar_url,
                    CASE WHEN fm.id IS NOT NULL THEN 1 ELSE 0 END as is_friend
             FROM users u
             LEFT JOIN family_members fm ON u.id = fm.member_id AND fm.user_id = ? AND fm.status = 1
             WHERE u.id != ?
-            ORDER BY u.username
-        ''', (current_user_id, current_user_id)).fetchall()
+        '''
+        params = [current_user_id, current_user_id]
+        
+        if prefix:
+            query += ' AND u.username >= ? AND u.username < ?'
+            params += [prefix, prefix_upper_bound(prefix)]
+        
+        if cursor:
+            cursor_username, _, cursor_id = cursor.rpartition(':')
+            try:
+                cursor_id = int(cursor_id)
+            except ValueError:
+                return jsonify({'success': False, 'message': '游标格式错误'}), 400
+            query += ' AND (u.username, u.id) > (?, ?)'
+            params += [cursor_username, cursor_id]
+        
+        query += ' ORDER BY u.username, u.id'
+        if limit is not None:
+            # 多取一条判断是否还有下一页
+            query += ' LIMIT ?'
+            params.append(limit + 1)
         
-        conn.close()
+        with db_connection() as conn:
+            users = conn.execute(query, params).fetchall()
+        
+        next_cursor = None
+        if limit is not None and len(users) > limit:
+            users = users[:limit]
+            next_cursor = f"{users[-1]['username']}:{users[-1]['id']}"
         
         result = []
         for user in users:
@@ -471,10 +2922,11 @@ def get_all_users(current_user_id):
                 'username': user['username'],
                 'phone': user['phone'],
                 'avatar_url': user['avatar_url'] or '',
+                'avatar_thumb_url': avatar_thumbnail_url(user['avatar_url']),
                 'is_friend': user['is_friend'] == 1
             })
         
-        return jsonify({'success': True, 'users': result})
+        return jsonify({'success': True, 'users': result, 'next_cursor': next_cursor})
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
@@ -488,26 +2940,23 @@ def check_username():
         if not username:
             return jsonify({'exists': False})
         
-        conn = get_db_connection()
-        
-        if exclude_user_id:
-            existing_user = conn.execute(
-                'SELECT id FROM users WHERE username = ? AND id != ?', 
-                (username, int(exclude_user_id))
-            ).fetchone()
-        else:
-            existing_user = conn.execute(
-                'SELECT id FROM users WHERE username = ?', (username,)
-            ).fetchone()
-            
-        conn.close()
+        with db_connection() as conn:
+            if exclude_user_id:
+                existing_user = conn.execute(
+                    'SELECT id FROM users WHERE username = ? AND id != ?', 
+                    (username, int(exclude_user_id))
+                ).fetchone()
+            else:
+                existing_user = conn.execute(
+                    'SELECT id FROM users WHERE username = ?', (username,)
+                ).fetchone()
         
         return jsonify({
             'exists': existing_user is not None
         })
         
     except Exception as e:
-        print(f"[{datetime.now()}] 检查用户名异常: {e}")
+        log_event(logging.ERROR, 'check_username.error', '检查用户名异常', error=str(e))
         return jsonify({'exists': False})
 
 @app.route('/api/check-phone', methods=['GET'])
@@ -518,20 +2967,37 @@ def check_phone():
         if not phone:
             return jsonify({'exists': False})
         
-        conn = get_db_connection()
-        existing_user = conn.execute(
-            'SELECT id FROM users WHERE phone = ?', (phone,)
-        ).fetchone()
-        conn.close()
+        with db_connection() as conn:
+            existing_user = conn.execute(
+                'SELECT id FROM users WHERE phone = ?', (phone,)
+            ).fetchone()
         
         return jsonify({
             'exists': existing_user is not None
         })
         
     except Exception as e:
-        print(f"[{datetime.now()}] 检查手机号异常: {e}")
+        log_event(logging.ERROR, 'check_phone.error', '检查手机号异常', error=str(e))
         return jsonify({'exists': False})
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """服务内部运行指标"""
+    return jsonify({
+        'success': True,
+        'auth': password_hasher.snapshot(),
+        'logging': logging_snapshot(),
+        'realtime_migration': legacy_realtime_migrator.snapshot(),
+        'realtime_partitions': realtime_partitions.snapshot(),
+        'realtime_archive': realtime_archive.snapshot(),
+        'realtime_blocks': realtime_blocks.snapshot(),
+        'realtime_buffer': realtime_write_buffer.snapshot(),
+        'db_writer': db_writer.snapshot(),
+        'avatar_thumbnails': avatar_thumbnailer.snapshot(),
+        'radar': radar_matcher.snapshot(),
+        'maintenance': maintenance_scheduler.snapshot()
+    })
+
 @app.route('/api/health-check', methods=['GET'])
 def health_check():
     return jsonify({
@@ -548,66 +3014,34 @@ def save_health_data():
         user_id = data.get('user_id')
         record_date = data.get('record_date', datetime.now().strftime('%Y-%m-%d'))
         
-        print(f"[{datetime.now()}] 保存健康数据: 用户{user_id}, 日期{record_date}")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 检查今日是否已有记录
-        existing = cursor.execute('''
-            SELECT id FROM health_data 
-            WHERE user_id = ? AND record_date = ?
-        ''', (user_id, record_date)).fetchone()
-        
-        health_fields = [
-            'steps', 'steps_goal', 'distance', 'calories_burned',
-            'current_heart_rate', 'resting_heart_rate', 'min_heart_rate', 'avg_heart_rate', 'max_heart_rate',
-            'current_blood_oxygen', 'min_blood_oxygen', 'avg_blood_oxygen', 'max_blood_oxygen',
-            'sleep_score', 'sleep_duration', 'sleep_start_time', 'sleep_end_time',
-            'deep_sleep_duration', 'light_sleep_duration', 'rem_sleep_duration', 'awake_duration',
-            'active_calories', 'calories_goal', 'basic_metabolism_calories',
-            'current_mood'
-        ]
+        # 只合并本次提供的字段，未提供的字段保持原值
+        provided = {f: data[f] for f in HEALTH_DATA_FIELDS if f in data and data[f] is not None}
         
-        if existing:
-            # 已有记录，执行增量更新
-            update_fields = []
-            values = []
-            
-            for field in health_fields:
-                if field in data and data[field] is not None:
-                    update_fields.append(f"{field} = ?")
-                    values.append(data[field])
-            
-            if update_fields:
-                update_fields.append("updated_at = CURRENT_TIMESTAMP")
-                sql = f"UPDATE health_data SET {', '.join(update_fields)} WHERE user_id = ? AND record_date = ?"
-                values.extend([user_id, record_date])
-                cursor.execute(sql, values)
-                print(f"[{datetime.now()}] 增量更新: 更新{len(update_fields)-1}个字段")
-        else:
-            # 新记录，执行插入
-            provided_fields = [f for f in health_fields if f in data and data[f] is not None]
-            if provided_fields:
-                placeholders = ', '.join(['?' for _ in provided_fields])
-                sql = f"INSERT INTO health_data (user_id, record_date, {', '.join(provided_fields)}, updated_at) VALUES (?, ?, {placeholders}, CURRENT_TIMESTAMP)"
-                values = [user_id, record_date] + [data[f] for f in provided_fields]
-                cursor.execute(sql, values)
-                print(f"[{datetime.now()}] 新增记录: 包含{len(provided_fields)}个字段")
-        
-        conn.commit()
-        conn.close()
+        try:
+            # 步数排行榜以整数ID为键、按整数步数排序，写入前先统一类型
+            user_id = int(user_id)
+            if 'steps' in provided:
+                provided['steps'] = parse_steps(provided['steps'])
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': '参数格式错误'}), 400
+        
+        log_event(logging.INFO, 'health_data.save', '保存健康数据', user_id=user_id, record_date=record_date)
+        
+        if provided:
+            db_writer.run(merge_health_data, user_id, record_date, provided)
+            health_data_versions.bump(user_id)
+            log_event(logging.DEBUG, 'health_data.merged', '健康数据合并更新', fields=len(provided))
         
         return jsonify({'success': True, 'message': '健康数据保存成功'})
         
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        print(f"[{datetime.now()}] 保存健康数据异常: {e}")
+        log_event(logging.ERROR, 'health_data.error', '保存健康数据异常', error=str(e))
         return jsonify({'success': False, 'message': f'保存失败: {str(e)}'}), 500
 
 @app.route('/api/realtime-data', methods=['POST'])
 def save_realtime_data():
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M')
-    
     try:
         data = request.get_json()
         user_id = data.get('user_id')
@@ -616,79 +3050,116 @@ def save_realtime_data():
         data_type = data.get('data_type')
         value = data.get('value')
         
-        print(f"[{current_time}] 保存实时数据: 用户{user_id}, 日期{record_date}, 时间{time_stamp}, 类型{data_type}, 数值{value}")        
+        log_event(logging.INFO, 'realtime.received', '保存实时数据', user_id=user_id, record_date=record_date,
+                  time_stamp=time_stamp, data_type=data_type, value=value)
         
         # 参数验证
         if not user_id or not time_stamp or not data_type or value is None:
             return jsonify({'success': False, 'message': '必要参数缺失'}), 400
+        if not is_numeric_value(value):
+            return jsonify({'success': False, 'message': '数值格式错误'}), 400
                 
-        # 时间格式验证和标准化 - 支持 YYYY-MM-DD HH:MM 和 HH:MM
-        if ':' not in time_stamp:
-            return jsonify({'success': False, 'message': '时间格式错误，应为YYYY-MM-DD HH:MM或HH:MM'}), 400
+        # 只有时间时补上记录日期，样本按完整时间存储
+        formatted_time, error_message = normalize_time_stamp(time_stamp, record_date)
+        if error_message:
+            return jsonify({'success': False, 'message': error_message}), 400
+        try:
+            ts = to_epoch_minute(formatted_time)
+        except ValueError:
+            return jsonify({'success': False, 'message': '记录日期格式无效，应为YYYY-MM-DD'}), 400
+        write_floor = realtime_write_floor()
+        if write_floor is not None and ts < write_floor:
+            return jsonify({'success': False, 'message': '该时间的数据已归档或已过保留期，不能再写入'}), 400
+        
+        # 数据类型验证
+        if data_type not in VALID_REALTIME_DATA_TYPES:
+            log_event(logging.WARNING, 'realtime.unknown_type', '未知数据类型', data_type=data_type)
+        
+        realtime_write_buffer.submit([(user_id, data_type, formatted_time, ts, value)])
+        
+        log_event(logging.INFO, 'realtime.saved', '实时数据保存成功', user_id=user_id)
+        return jsonify({'success': True, 'message': '实时数据保存成功'})
+        
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
+    except Exception as e:
+        log_event(logging.ERROR, 'realtime.error', '保存实时数据异常', error=str(e))
+        return jsonify({'success': False, 'message': f'保存失败: {str(e)}'}), 500
 
-        # 处理完整日期时间格式
-        if ' ' in time_stamp and '-' in time_stamp:
-            try:
-                datetime.strptime(time_stamp, '%Y-%m-%d %H:%M')
-                formatted_time = time_stamp
-                print(f"[{current_time}] 接收完整时间戳: {formatted_time}")
-            except ValueError:
-                return jsonify({'success': False, 'message': '日期时间格式无效，应为YYYY-MM-DD HH:MM'}), 400
-        else:
-            # 处理只有时间的格式，补充当前日期
-            time_parts = time_stamp.split(':')
-            if len(time_parts) != 2:
-                return jsonify({'success': False, 'message': '时间格式错误'}), 400
-            
-            try:
-                hour = int(time_parts[0])
-                minute = int(time_parts[1])
-                if hour < 0 or hour > 23 or minute < 0 or minute > 59:
-                    return jsonify({'success': False, 'message': '时间值超出范围'}), 400
-                current_date = datetime.now().strftime('%Y-%m-%d')
-                formatted_time = f"{current_date} {hour:02d}:{minute:02d}"
-                print(f"[{current_time}] 补充日期后的时间戳: {formatted_time}")
-            except ValueError:
-                return jsonify({'success': False, 'message': '时间格式无效'}), 400
+@app.route('/api/realtime-data/batch', methods=['POST'])
+def save_realtime_data_batch():
+    """批量保存同一用户的实时数据，整批入队，与其他请求的样本合并提交"""
+    try:
+        data = request.get_json()
+        user_id = data.get('user_id')
+        samples = data.get('samples')
         
-        # 数据类型验证
-        valid_data_types = ['heart_rate', 'blood_oxygen', 'mood']
-        if data_type not in valid_data_types:
-            print(f"[{current_time}] 警告: 未知数据类型 {data_type}")
+        if not user_id or not isinstance(samples, list) or not samples:
+            return jsonify({'success': False, 'message': '必要参数缺失'}), 400
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if len(samples) > MAX_REALTIME_BATCH_SIZE:
+            return jsonify({
+                'success': False,
+                'message': f'单次最多上传{MAX_REALTIME_BATCH_SIZE}条数据'
+            }), 400
         
-        # 检查是否已存在相同记录
-        existing = cursor.execute('''
-            SELECT id FROM realtime_data 
-            WHERE user_id = ? AND record_date = ? AND time_stamp = ? AND data_type = ?
-        ''', (user_id, record_date, formatted_time, data_type)).fetchone()
+        log_event(logging.INFO, 'realtime_batch.received', '批量保存实时数据', user_id=user_id, count=len(samples))
+        
+        # 一次遍历完成校验和时间标准化，不合法的条目单独记录下来
+        current_date = datetime.now().strftime('%Y-%m-%d')
+        write_floor = realtime_write_floor()
+        rows = []
+        rejected = []
+        for index, sample in enumerate(samples):
+            if not isinstance(sample, dict):
+                rejected.append({'index': index, 'message': '数据格式错误'})
+                continue
+            
+            time_stamp = sample.get('time_stamp')
+            data_type = sample.get('data_type')
+            value = sample.get('value')
+            
+            if not time_stamp or not data_type or value is None:
+                rejected.append({'index': index, 'message': '必要参数缺失'})
+                continue
+            
+            if not is_numeric_value(value):
+                rejected.append({'index': index, 'message': '数值格式错误'})
+                continue
+            
+            # 只有时间的样本优先补上样本自带的记录日期，便于整天回填
+            formatted_time, error_message = normalize_time_stamp(time_stamp, sample.get('record_date') or current_date)
+            if error_message:
+                rejected.append({'index': index, 'message': error_message})
+                continue
+            try:
+                ts = to_epoch_minute(formatted_time)
+            except ValueError:
+                rejected.append({'index': index, 'message': '记录日期格式无效'})
+                continue
+            if write_floor is not None and ts < write_floor:
+                rejected.append({'index': index, 'message': '数据已归档或已过保留期'})
+                continue
+            
+            rows.append((user_id, data_type, formatted_time, ts, value))
         
-        if existing:
-            # 更新现有记录
-            cursor.execute('''
-                UPDATE realtime_data 
-                SET value = ?, created_at = CURRENT_TIMESTAMP 
-                WHERE user_id = ? AND record_date = ? AND time_stamp = ? AND data_type = ?
-            ''', (value, user_id, record_date, formatted_time, data_type))
-            print(f"[{current_time}] 更新实时数据记录")
-        else:
-            # 插入新记录
-            cursor.execute('''
-                INSERT INTO realtime_data (user_id, record_date, time_stamp, data_type, value)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, record_date, formatted_time, data_type, value))
-            print(f"[{current_time}] 新增实时数据记录")
+        if rows:
+            realtime_write_buffer.submit(rows)
         
-        conn.commit()
-        conn.close()
+        log_event(logging.INFO, 'realtime_batch.saved', '批量实时数据保存完成',
+                  user_id=user_id, accepted=len(rows), rejected=len(rejected))
         
-        print(f"[{current_time}] 实时数据保存成功")
-        return jsonify({'success': True, 'message': '实时数据保存成功'})
+        return jsonify({
+            'success': True,
+            'message': '实时数据保存成功',
+            'accepted': len(rows),
+            'rejected': rejected
+        })
         
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        print(f"[{current_time}] 保存实时数据异常: {e}")
+        log_event(logging.ERROR, 'realtime_batch.error', '批量保存实时数据异常', error=str(e))
         return jsonify({'success': False, 'message': f'保存失败: {str(e)}'}), 500
 
 @app.route('/api/health-data/<int:user_id>', methods=['GET'])
@@ -696,16 +3167,17 @@ def get_health_data(user_id):
     try:
         days = int(request.args.get('days', 7))
         
-        conn = get_db_connection()
-        
-        health_data = conn.execute('''
+        query = '''
             SELECT * FROM health_data 
             WHERE user_id = ? 
             ORDER BY record_date DESC 
             LIMIT ?
-        ''', (user_id, days)).fetchall()
+        '''
+        if wants_stream(days):
+            return stream_json_rows(query, (user_id, days))
         
-        conn.close()
+        with db_connection() as conn:
+            health_data = conn.execute(query, (user_id, days)).fetchall()
         
         result = []
         for row in health_data:
@@ -719,157 +3191,211 @@ def get_health_data(user_id):
 @app.route('/api/realtime-data/<int:user_id>', methods=['GET'])
 def get_realtime_data(user_id):
     try:
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M')
         record_date = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
         data_type = request.args.get('type')
         days_param = request.args.get('days')
         days = int(days_param) if days_param is not None else 1
+        resolution = request.args.get('resolution', 'raw')
         
-        print(f"[{current_time}] 获取实时数据: 用户{user_id}, 类型{data_type}, 天数{days}")
+        if resolution not in ('raw', 'auto') and resolution not in REALTIME_ROLLUP_RESOLUTIONS:
+            return jsonify({'success': False, 'message': 'resolution参数无效，应为raw、5m、1h、1d或auto'}), 400
+        if resolution == 'auto':
+            resolution = choose_realtime_resolution(max(days, 1))
         
-        conn = get_db_connection()
+        log_event(logging.DEBUG, 'realtime.query', '获取实时数据', user_id=user_id, data_type=data_type,
+                  days=days, resolution=resolution)
         
         if days > 1:
             end_date = datetime.now().date()
             start_date = end_date - timedelta(days=days-1)
-            query = 'SELECT * FROM realtime_data WHERE user_id = ? AND record_date BETWEEN ? AND ?'
-            params = [user_id, start_date.isoformat(), end_date.isoformat()]
+            date_range = (start_date.isoformat(), end_date.isoformat())
         else:
-            query = 'SELECT * FROM realtime_data WHERE user_id = ? AND record_date = ?'
-            params = [user_id, record_date]
+            date_range = (record_date, record_date)
         
+        if resolution == 'raw':
+            try:
+                ts_start = to_epoch_minute(f'{date_range[0]} 00:00')
+                ts_end = to_epoch_minute(f'{date_range[1]} 00:00') + 1440
+            except ValueError:
+                return jsonify({'success': False, 'message': '日期格式无效，应为YYYY-MM-DD'}), 400
+            # 原始样本按月分区，只查询时间范围涉及的月份
+            make_rows = lambda conn: iter_realtime_rows(conn, user_id, ts_start, ts_end, data_type)
+            if wants_stream(days):
+                return stream_json_iter(make_rows, extra={'resolution': resolution})
+            with db_connection() as conn:
+                result = list(make_rows(conn))
+            return jsonify({'success': True, 'data': result, 'resolution': resolution})
+        
+        # 汇总桶按时间戳所在日期筛选，value 为桶内平均值
+        query = '''
+            SELECT user_id, data_type, bucket_start AS time_stamp,
+                   substr(bucket_start, 1, 10) AS record_date,
+                   ROUND(sum_value / sample_count, 2) AS value,
+                   min_value, max_value, ROUND(sum_value / sample_count, 2) AS avg_value,
+                   sample_count, last_value
+            FROM realtime_rollups
+            WHERE user_id = ? AND resolution = ? AND bucket_start BETWEEN ? AND ?
+        '''
+        params = [user_id, REALTIME_ROLLUP_RESOLUTIONS[resolution],
+                  f'{date_range[0]} 00:00', f'{date_range[1]} 23:59']
         if data_type:
             query += ' AND data_type = ?'
             params.append(data_type)
         
         query += ' ORDER BY time_stamp DESC'
         
-        realtime_data = conn.execute(query, params).fetchall()
-        conn.close()
+        if wants_stream(days):
+            return stream_json_rows(query, params, extra={'resolution': resolution})
+        
+        with db_connection() as conn:
+            realtime_data = conn.execute(query, params).fetchall()
         
         result = []
         for row in realtime_data:
             result.append(dict(row))
         
-        return jsonify({'success': True, 'data': result})
+        return jsonify({'success': True, 'data': result, 'resolution': resolution})
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
 
+STEPS_RANKING_MAX_LIMIT = 200
+
 @app.route('/api/steps-ranking', methods=['GET'])
 def get_steps_ranking():
     try:
-        today = datetime.now().strftime('%Y-%m-%d')
-        print(f"[{datetime.now()}] 获取步数排行榜请求，日期: {today}")
-        
-        conn = get_db_connection()
-        
-        # 添加调试：查看今日所有health_data记录，使用TRIM和字符串比较
-        debug_data = conn.execute('''
-            SELECT user_id, username, record_date, steps 
-            FROM health_data h
-            JOIN users u ON h.user_id = u.id
-            WHERE TRIM(h.record_date, "'") = ?
-        ''', (today,)).fetchall()
-            
-        print(f"[{datetime.now()}] 今日health_data记录:")
-        for row in debug_data:
-            print(f"  用户ID: {row['user_id']}, 用户名: {row['username']}, 日期: {row['record_date']}, 步数: {row['steps']}")
-        
-        # 使用LEFT JOIN确保显示所有用户
-        ranking = conn.execute('''
-            SELECT u.username, COALESCE(h.steps, 0) as steps
-            FROM users u
-            LEFT JOIN health_data h ON u.id = h.user_id AND TRIM(h.record_date, "'") = ?
-            ORDER BY COALESCE(h.steps, 0) DESC, u.username ASC
-            LIMIT 50
-        ''', (today,)).fetchall()
-        
-        conn.close()
+        record_date = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
+        try:
+            limit = int(request.args.get('limit', 50))
+        except ValueError:
+            return jsonify({'success': False, 'message': '参数格式错误'}), 400
+        limit = min(max(limit, 1), STEPS_RANKING_MAX_LIMIT)
         
         result = []
-        for i, row in enumerate(ranking):
+        for rank, user_id, steps, username in steps_leaderboard.board(record_date).top(limit):
             result.append({
-                'rank': i + 1,
-                'username': row['username'],
-                'steps': row['steps']
+                'rank': rank,
+                'user_id': user_id,
+                'username': username,
+                'steps': steps
             })
-            print(f"[{datetime.now()}] 排行榜第{i+1}名: {row['username']}, {row['steps']}步")
-        
-        print(f"[{datetime.now()}] 排行榜查询完成，共{len(result)}名用户")
         
         return jsonify({'success': True, 'ranking': result})
         
     except Exception as e:
-        print(f"[{datetime.now()}] 获取排行榜异常: {e}")
+        log_event(logging.ERROR, 'steps_ranking.error', '获取排行榜异常', error=str(e))
+        return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
+
+@app.route('/api/steps-rank/<int:user_id>', methods=['GET'])
+def get_steps_rank(user_id):
+    """查询某个用户在步数排行榜上的名次"""
+    try:
+        record_date = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
+        board = steps_leaderboard.board(record_date)
+        
+        rank_info = board.rank_of(user_id)
+        if rank_info is None:
+            return jsonify({'success': False, 'message': '用户不存在'}), 404
+        
+        rank, steps = rank_info
+        return jsonify({
+            'success': True,
+            'data': {
+                'user_id': user_id,
+                'rank': rank,
+                'steps': steps,
+                'total': len(board)
+            }
+        })
+        
+    except Exception as e:
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
 
+def overview_payload(overview):
+    """今日概览：没有当天数据时返回默认值"""
+    if overview:
+        return {
+            'steps': overview['steps'] or 0,
+            'current_heart_rate': overview['current_heart_rate'] or 0,
+            'avg_heart_rate': overview['current_heart_rate'] or 0,  # 添加这个字段
+            'sleep_score': overview['sleep_score'] or 0,
+            'active_calories': overview['active_calories'] or 0,
+            'basic_metabolism_calories': overview['basic_metabolism_calories'] or 0,
+            'blood_oxygen': overview['current_blood_oxygen'] or 0,
+            'current_mood': overview['current_mood'] if overview['current_mood'] is not None else -1
+        }
+    return {
+        'steps': 0,
+        'avg_heart_rate': 0,
+        'sleep_score': 0,
+        'active_calories': 0,
+        'basic_metabolism_calories': 0,
+        'blood_oxygen': 0,
+        'current_mood': -1
+    }
+
+def weekly_steps_payload(rows):
+    return [{'date': row['record_date'], 'steps': row['steps'] or 0} for row in rows]
+
+def weekly_sleep_payload(rows):
+    return [{
+        'date': row['record_date'],
+        'sleep_score': row['sleep_score'] or 0,
+        'sleep_duration': row['sleep_duration'] or 0
+    } for row in rows]
+
+def weekly_calories_payload(rows):
+    return [{'date': row['record_date'], 'calories': row['active_calories'] or 0} for row in rows]
+
+# 首页面板 -> 生成函数，周数据面板接收最近7天的行，overview 只接收当天一行
+DASHBOARD_PANELS = {
+    'overview': overview_payload,
+    'weekly_steps': weekly_steps_payload,
+    'weekly_sleep': weekly_sleep_payload,
+    'weekly_calories': weekly_calories_payload
+}
+
 @app.route('/api/overview/<int:user_id>', methods=['GET'])
+@health_data_etag
 def get_overview(user_id):
     try:
         today = datetime.now().strftime('%Y-%m-%d')
-        print(f"[{datetime.now()}] 获取用户{user_id}的健康概览数据，日期: {today}")
+        log_event(logging.DEBUG, 'overview.query', '获取健康概览', user_id=user_id, record_date=today)
         
-        conn = get_db_connection()
-        
-        # 修复：添加current_mood字段和TRIM处理
-        overview = conn.execute('''
-            SELECT steps, current_heart_rate, sleep_score, active_calories, basic_metabolism_calories, current_blood_oxygen, current_mood
-            FROM health_data 
-            WHERE user_id = ? AND record_date = ?
-        ''', (user_id, today)).fetchone()
-                    
-        conn.close()
+        with db_connection() as conn:
+            # 修复：添加current_mood字段和TRIM处理
+            overview = conn.execute('''
+                SELECT steps, current_heart_rate, sleep_score, active_calories, basic_metabolism_calories, current_blood_oxygen, current_mood
+                FROM health_data 
+                WHERE user_id = ? AND record_date = ?
+            ''', (user_id, today)).fetchone()
         
-        if overview:
-            result = {
-                'steps': overview['steps'] or 0,
-                'current_heart_rate': overview['current_heart_rate'] or 0,
-                'avg_heart_rate': overview['current_heart_rate'] or 0,  # 添加这个字段
-                'sleep_score': overview['sleep_score'] or 0,
-                'active_calories': overview['active_calories'] or 0,
-                'basic_metabolism_calories': overview['basic_metabolism_calories'] or 0,
-                'blood_oxygen': overview['current_blood_oxygen'] or 0,
-                'current_mood': overview['current_mood'] if overview['current_mood'] is not None else -1
-            }
-        else:
-            result = {
-                'steps': 0,
-                'avg_heart_rate': 0,
-                'sleep_score': 0,
-                'active_calories': 0,
-                'basic_metabolism_calories': 0,
-                'blood_oxygen': 0,
-                'current_mood': -1
-            }
-            print(f"[{datetime.now()}] 用户{user_id}今日无健康数据，返回默认值")
+        result = overview_payload(overview)
+        if overview is None:
+            log_event(logging.DEBUG, 'overview.empty', '今日无健康数据，返回默认值', user_id=user_id)
         
         return jsonify({'success': True, 'data': result})
         
     except Exception as e:
-        print(f"[{datetime.now()}] 获取健康概览异常: {e}")
+        log_event(logging.ERROR, 'overview.error', '获取健康概览异常', error=str(e))
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
 
 # 在现有接口后添加
 @app.route('/api/weekly-steps/<int:user_id>', methods=['GET'])
+@health_data_etag
 def get_weekly_steps(user_id):
     try:
         end_date = datetime.now().date()
         start_date = end_date - timedelta(days=6)
         
-        conn = get_db_connection()
-        
-        weekly_data = conn.execute('''
-            SELECT record_date, steps FROM health_data 
-            WHERE user_id = ? AND record_date BETWEEN ? AND ?
-            ORDER BY record_date
-        ''', (user_id, start_date.isoformat(), end_date.isoformat())).fetchall()
+        with db_connection() as conn:
+            weekly_data = conn.execute('''
+                SELECT record_date, steps FROM health_data 
+                WHERE user_id = ? AND record_date BETWEEN ? AND ?
+                ORDER BY record_date
+            ''', (user_id, start_date.isoformat(), end_date.isoformat())).fetchall()
         
-        conn.close()
-        
-        result = []
-        for row in weekly_data:
-            result.append({'date': row['record_date'], 'steps': row['steps'] or 0})
+        result = weekly_steps_payload(weekly_data)
         
         return jsonify({'success': True, 'data': result})
         
@@ -877,28 +3403,20 @@ def get_weekly_steps(user_id):
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
 
 @app.route('/api/weekly-sleep/<int:user_id>', methods=['GET'])
+@health_data_etag
 def get_weekly_sleep(user_id):
     try:
         end_date = datetime.now().date()
         start_date = end_date - timedelta(days=6)
         
-        conn = get_db_connection()
-        
-        weekly_data = conn.execute('''
-            SELECT record_date, sleep_score, sleep_duration FROM health_data 
-            WHERE user_id = ? AND record_date BETWEEN ? AND ?
-            ORDER BY record_date
-        ''', (user_id, start_date.isoformat(), end_date.isoformat())).fetchall()
-        
-        conn.close()
+        with db_connection() as conn:
+            weekly_data = conn.execute('''
+                SELECT record_date, sleep_score, sleep_duration FROM health_data 
+                WHERE user_id = ? AND record_date BETWEEN ? AND ?
+                ORDER BY record_date
+            ''', (user_id, start_date.isoformat(), end_date.isoformat())).fetchall()
         
-        result = []
-        for row in weekly_data:
-            result.append({
-                'date': row['record_date'], 
-                'sleep_score': row['sleep_score'] or 0,
-                'sleep_duration': row['sleep_duration'] or 0
-            })
+        result = weekly_sleep_payload(weekly_data)
         
         return jsonify({'success': True, 'data': result})
         
@@ -915,13 +3433,11 @@ def search_users():
         if not phone or not current_user_id:
             return jsonify({'success': False, 'message': '参数缺失'}), 400
         
-        conn = get_db_connection()
-        user = conn.execute('''
-            SELECT id, username, phone FROM users 
-            WHERE phone = ? AND id != ?
-        ''', (phone, current_user_id)).fetchone()
-        
-        conn.close()
+        with db_connection() as conn:
+            user = conn.execute('''
+                SELECT id, username, phone FROM users 
+                WHERE phone = ? AND id != ?
+            ''', (phone, current_user_id)).fetchone()
         
         if user:
             return jsonify({
@@ -946,25 +3462,16 @@ def add_family_member():
         member_id = data.get('member_id')
         relationship_name = data.get('relationship_name', '家庭成员')
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         # 双向添加家庭成员关系
-        cursor.execute('''
-            INSERT OR IGNORE INTO family_members (user_id, member_id, relationship_name)
-            VALUES (?, ?, ?)
-        ''', (user_id, member_id, relationship_name))
-        
-        cursor.execute('''
+        db_writer.run(lambda conn: conn.executemany('''
             INSERT OR IGNORE INTO family_members (user_id, member_id, relationship_name)
             VALUES (?, ?, ?)
-        ''', (member_id, user_id, relationship_name))
-        
-        conn.commit()
-        conn.close()
+        ''', [(user_id, member_id, relationship_name), (member_id, user_id, relationship_name)]).rowcount)
         
         return jsonify({'success': True, 'message': '添加家庭成员成功'})
         
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
         return jsonify({'success': False, 'message': f'添加失败: {str(e)}'}), 500
 
@@ -976,68 +3483,54 @@ def save_steps_record():
         steps = data.get('steps')
         record_date = data.get('record_date', datetime.now().strftime('%Y-%m-%d'))
         
-        print(f"[{datetime.now()}] 保存步数记录: 用户{user_id}, 步数{steps}, 日期{record_date}")
+        try:
+            # 排行榜以整数ID为键，"2" 与 2 必须是同一个用户
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': '参数格式错误'}), 400
+        
+        log_event(logging.INFO, 'steps.save', '保存步数记录', user_id=user_id, steps=steps, record_date=record_date)
         
         # 计算积分 (每500步=1积分)
         points_earned = int(steps // 500)
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 检查今日是否已有记录
-        existing = cursor.execute('''
-            SELECT steps, points_earned FROM steps_records 
-            WHERE user_id = ? AND record_date = ?
-        ''', (user_id, record_date)).fetchone()
+        def save_steps(conn):
+            cursor = conn.cursor()
         
-        if existing:
-            # 更新现有记录
-            old_points = existing['points_earned']
-            cursor.execute('''
-                UPDATE steps_records 
-                SET steps = ?, points_earned = ? 
+            # 积分差额依赖旧记录，读写放在同一个写事务里，避免其他进程并发同步时重复计分
+            conn.execute('BEGIN IMMEDIATE')
+            existing = cursor.execute('''
+                SELECT points_earned FROM steps_records 
                 WHERE user_id = ? AND record_date = ?
-            ''', (steps, points_earned, user_id, record_date))
-            
-            # 更新积分差额
-            points_diff = points_earned - old_points
-        else:
-            # 创建新记录
-            cursor.execute('''
-                INSERT INTO steps_records (user_id, steps, points_earned, record_date)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, steps, points_earned, record_date))
-            points_diff = points_earned
-        
-        # 更新用户总积分
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_points (user_id, total_points, updated_at)
-            VALUES (?, COALESCE((SELECT total_points FROM user_points WHERE user_id = ?), 0) + ?, CURRENT_TIMESTAMP)
-        ''', (user_id, user_id, points_diff))
-        
-        # 记录积分历史
-        if points_diff != 0:
-            cursor.execute('''
-                INSERT INTO points_history (user_id, points, source_type, source_data, record_date)
-                VALUES (?, ?, 'steps', ?, ?)
-            ''', (user_id, points_diff, f'步数: {steps}', record_date))
+            ''', (user_id, record_date)).fetchone()
+            points_diff = points_earned - (existing['points_earned'] if existing else 0)
+        
+            upsert(
+                cursor, 'steps_records',
+                {'user_id': user_id, 'record_date': record_date},
+                {'steps': steps, 'points_earned': points_earned}
+            )
+        
+            # 更新用户总积分
+            total_points = increment_user_points(cursor, user_id, points_diff)
         
-        # 同时更新health_data表的步数
-        cursor.execute('''
-            INSERT OR REPLACE INTO health_data (user_id, record_date, steps, updated_at)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, record_date, steps))
+            # 记录积分历史
+            if points_diff != 0:
+                cursor.execute('''
+                    INSERT INTO points_history (user_id, points, source_type, source_data, record_date)
+                    VALUES (?, ?, 'steps', ?, ?)
+                ''', (user_id, points_diff, f'步数: {steps}', record_date))
         
-        # 获取总积分
-        total_points_row = cursor.execute('''
-            SELECT total_points FROM user_points WHERE user_id = ?
-        ''', (user_id,)).fetchone()
-        total_points = total_points_row['total_points'] if total_points_row else 0
+            # 同时更新health_data表的步数，其他指标保持不变
+            merge_health_data(conn, user_id, record_date, {'steps': steps})
+            db_writer.after_commit(points_leaderboard.set_points, user_id, total_points)
+            return total_points
         
-        conn.commit()
-        conn.close()
+        total_points = db_writer.run(save_steps)
         
-        print(f"[{datetime.now()}] 步数保存成功: 获得积分{points_earned}, 总积分{total_points}")
+        health_data_versions.bump(user_id)
+        log_event(logging.INFO, 'steps.saved', '步数保存成功', user_id=user_id,
+                  points_earned=points_earned, total_points=total_points)
         
         return jsonify({
             'success': True,
@@ -1046,8 +3539,10 @@ def save_steps_record():
             'total_points': total_points
         })
         
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        print(f"[{datetime.now()}] 保存步数异常: {e}")
+        log_event(logging.ERROR, 'steps.error', '保存步数异常', error=str(e))
         return jsonify({'success': False, 'message': f'保存失败: {str(e)}'}), 500
 
 @app.route('/api/steps-history/<int:user_id>', methods=['GET'])
@@ -1055,32 +3550,26 @@ def get_steps_history(user_id):
     try:
         days = int(request.args.get('days', 30))
         
-        conn = get_db_connection()
-        
-        records = conn.execute('''
-            SELECT * FROM steps_records 
+        query = '''
+            SELECT id, steps, points_earned, record_date, created_at FROM steps_records 
             WHERE user_id = ? 
             ORDER BY record_date DESC 
             LIMIT ?
-        ''', (user_id, days)).fetchall()
+        '''
+        if wants_stream(days):
+            return stream_json_rows(query, (user_id, days), key='records')
         
-        conn.close()
+        with db_connection() as conn:
+            records = conn.execute(query, (user_id, days)).fetchall()
         
         result = []
         for row in records:
-            result.append({
-                'id': row['id'],
-                'steps': row['steps'],
-                'points_earned': row['points_earned'],
-                'record_date': row['record_date'],
-                'created_at': row['created_at']
-            })
+            result.append(dict(row))
         
         return jsonify({'success': True, 'records': result})
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
-    
 
 @app.route('/api/update-username', methods=['POST'])
 def update_username():
@@ -1089,7 +3578,7 @@ def update_username():
         user_id = data.get('user_id')
         new_username = data.get('new_username', '').strip()
         
-        print(f"[{datetime.now()}] 更新用户名请求: 用户{user_id}, 新用户名={new_username}")
+        log_event(logging.INFO, 'username.update', '更新用户名请求', user_id=user_id, new_username=new_username)
         
         if not user_id or not new_username:
             return jsonify({
@@ -1103,39 +3592,37 @@ def update_username():
                 'message': '用户名长度应在2-20个字符之间'
             }), 400
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def rename(conn):
+            cursor = conn.cursor()
         
-        # 检查新用户名是否已存在
-        existing = cursor.execute(
-            'SELECT id FROM users WHERE username = ? AND id != ?', 
-            (new_username, user_id)
-        ).fetchone()
+            # 检查新用户名是否已存在
+            existing = cursor.execute(
+                'SELECT id FROM users WHERE username = ? AND id != ?', 
+                (new_username, user_id)
+            ).fetchone()
         
-        if existing:
-            conn.close()
-            return jsonify({
-                'success': False,
-                'message': '该用户名已被使用'
-            }), 400
+            if existing:
+                return '该用户名已被使用', 400
         
-        # 更新用户名
-        cursor.execute(
-            'UPDATE users SET username = ? WHERE id = ?',
-            (new_username, user_id)
-        )
+            # 更新用户名
+            cursor.execute(
+                'UPDATE users SET username = ? WHERE id = ?',
+                (new_username, user_id)
+            )
         
-        if cursor.rowcount == 0:
-            conn.close()
+            if cursor.rowcount == 0:
+                return '用户不存在', 404
+            db_writer.after_commit(steps_leaderboard.rename_user, user_id, new_username)
+            return None, None
+        
+        error, status = db_writer.run(rename)
+        if error:
             return jsonify({
                 'success': False,
-                'message': '用户不存在'
-            }), 404
-        
-        conn.commit()
-        conn.close()
+                'message': error
+            }), status
         
-        print(f"[{datetime.now()}] 用户名更新成功: 用户{user_id} -> {new_username}")
+        log_event(logging.INFO, 'username.updated', '用户名更新成功', user_id=user_id, new_username=new_username)
         
         return jsonify({
             'success': True,
@@ -1143,8 +3630,10 @@ def update_username():
             'new_username': new_username
         })
         
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        print(f"[{datetime.now()}] 更新用户名异常: {e}")
+        log_event(logging.ERROR, 'username.error', '更新用户名异常', error=str(e))
         return jsonify({
             'success': False,
             'message': f'更新失败: {str(e)}'
@@ -1153,13 +3642,10 @@ def update_username():
 @app.route('/api/user-points/<int:user_id>', methods=['GET'])
 def get_user_points(user_id):
     try:
-        conn = get_db_connection()
-        
-        points_info = conn.execute('''
-            SELECT * FROM user_points WHERE user_id = ?
-        ''', (user_id,)).fetchone()
-        
-        conn.close()
+        with db_connection() as conn:
+            points_info = conn.execute('''
+                SELECT * FROM user_points WHERE user_id = ?
+            ''', (user_id,)).fetchone()
         
         if points_info:
             result = {
@@ -1180,72 +3666,153 @@ def get_user_points(user_id):
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
 
 
+RADAR_TTL_SECONDS = 300            # 雷达码无人匹配时的保留时间
+RADAR_MAX_WAIT_SECONDS = 25        # 单次请求最长挂起时间（长轮询）
+RADAR_RECENT_MATCH_SECONDS = 60    # 匹配结果为等待方保留的时间
+
+class RadarMatcher:
+    """面对面加好友的内存匹配器：雷达码 -> 等待中的用户，超时自动失效。
+
+    后到的一方完成匹配并写入双向家庭成员关系，再唤醒长轮询中的等待方；
+    等待方若已超时返回，重新提交同一雷达码时从最近匹配结果中取回对方。
+    状态只在本进程内，需以单进程方式运行服务。
+    """
+
+    def __init__(self, ttl=RADAR_TTL_SECONDS, recent_ttl=RADAR_RECENT_MATCH_SECONDS):
+        self.ttl = ttl
+        self.recent_ttl = recent_ttl
+        self._cond = threading.Condition()
+        self._waiting = {}     # radar_code -> (user_id, 过期时间)
+        self._matches = {}     # (user_id, radar_code) -> (对方user_id, 过期时间)
+        self.matched = 0
+        self.expired = 0
+
+    def purge(self, now=None):
+        """清理过期的等待者和匹配结果，返回清理数量"""
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            stale_codes = [code for code, (_, expires) in self._waiting.items() if expires <= now]
+            for code in stale_codes:
+                del self._waiting[code]
+            stale_matches = [key for key, (_, expires) in self._matches.items() if expires <= now]
+            for key in stale_matches:
+                del self._matches[key]
+            self.expired += len(stale_codes)
+        return len(stale_codes) + len(stale_matches)
+
+    def _take_match(self, user_id, radar_code):
+        match = self._matches.pop((user_id, radar_code), None)
+        return match[0] if match else None
+
+    def join(self, user_id, radar_code, on_match, wait=0):
+        """提交雷达码，返回匹配到的对方user_id，wait秒内无人匹配返回None。
+
+        on_match(user_id, partner_id) 在锁外执行（写数据库），失败时恢复对方的等待状态并抛出异常
+        """
+        now = time.monotonic()
+        deadline = now + max(0, min(wait, RADAR_MAX_WAIT_SECONDS))
+        self.purge(now)
+        with self._cond:
+            partner_id = self._take_match(user_id, radar_code)
+            if partner_id is not None:
+                return partner_id
+            waiter = self._waiting.get(radar_code)
+            if waiter and waiter[0] != user_id:
+                del self._waiting[radar_code]
+                partner_id = waiter[0]
+            else:
+                self._waiting[radar_code] = (user_id, now + self.ttl)
+
+        if partner_id is not None:
+            try:
+                on_match(user_id, partner_id)
+            except Exception:
+                with self._cond:
+                    self._waiting.setdefault(radar_code, waiter)
+                raise
+            with self._cond:
+                self._matches[(partner_id, radar_code)] = (user_id, time.monotonic() + self.recent_ttl)
+                self.matched += 1
+                self._cond.notify_all()
+            return partner_id
+
+        # 长轮询：等待对方到来或超时
+        with self._cond:
+            while True:
+                partner_id = self._take_match(user_id, radar_code)
+                if partner_id is not None:
+                    return partner_id
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'waiting': len(self._waiting),
+                'pending_results': len(self._matches),
+                'matched': self.matched,
+                'expired': self.expired
+            }
+
+radar_matcher = RadarMatcher()
+
+def add_family_pair(user_id, member_id):
+    """在一个事务中写入双向家庭成员关系"""
+    db_writer.run(lambda conn: conn.execute('''
+        INSERT OR IGNORE INTO family_members (user_id, member_id)
+        VALUES (?, ?), (?, ?)
+    ''', (user_id, member_id, member_id, user_id)).rowcount)
+
 @app.route('/api/radar-friends', methods=['POST'])
 def create_radar_session():
+    """面对面加好友：双方提交相同的雷达码即可互加。
+
+    wait 为最长等待秒数（上限 RADAR_MAX_WAIT_SECONDS），无人匹配时请求会挂起直到对方到来或超时；
+    不传时立即返回，与旧客户端的定时重试兼容
+    """
     try:
         data = request.get_json()
         user_id = data.get('user_id')
         radar_code = data.get('radar_code')
         
-        expires_at = (datetime.now() + timedelta(minutes=5)).isoformat()
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if not user_id or not radar_code:
+            return jsonify({'success': False, 'message': '参数缺失'}), 400
+        try:
+            user_id = int(user_id)
+            wait = float(data.get('wait', 0))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': '参数格式错误'}), 400
         
-        # 清理过期记录
-        cursor.execute('DELETE FROM friend_radar WHERE expires_at < ?', (datetime.now().isoformat(),))
+        partner_id = radar_matcher.join(user_id, radar_code, add_family_pair, wait)
         
-        # 检查是否有匹配的雷达码
-        existing = cursor.execute('''
-            SELECT user_id FROM friend_radar 
-            WHERE radar_code = ? AND user_id != ?
-        ''', (radar_code, user_id)).fetchone()
+        if partner_id is not None:
+            log_event(logging.INFO, 'radar.matched', '雷达匹配成功', user_id=user_id, member_id=partner_id)
+            return jsonify({
+                'success': True,
+                'message': '匹配成功，已添加为家庭成员',
+                'matched': True,
+                'member_id': partner_id
+            })
+        return jsonify({'success': True, 'message': '等待其他用户匹配', 'matched': False})
         
-        if existing:
-            # 找到匹配，添加为家庭成员
-            other_user_id = existing['user_id']
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO family_members (user_id, member_id)
-                VALUES (?, ?), (?, ?)
-            ''', (user_id, other_user_id, other_user_id, user_id))
-            
-            # 清理雷达记录
-            cursor.execute('DELETE FROM friend_radar WHERE radar_code = ?', (radar_code,))
-            
-            conn.commit()
-            conn.close()
-            
-            return jsonify({'success': True, 'message': '匹配成功，已添加为家庭成员', 'matched': True})
-        else:
-            # 没有匹配，创建新记录
-            cursor.execute('''
-                INSERT OR REPLACE INTO friend_radar (user_id, radar_code, expires_at)
-                VALUES (?, ?, ?)
-            ''', (user_id, radar_code, expires_at))
-            
-            conn.commit()
-            conn.close()
-            
-            return jsonify({'success': True, 'message': '等待其他用户匹配', 'matched': False})
-            
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
         return jsonify({'success': False, 'message': f'操作失败: {str(e)}'}), 500
 
 @app.route('/api/family-members/<int:user_id>', methods=['GET'])
 def get_family_members(user_id):
     try:
-        conn = get_db_connection()
-        
-        members = conn.execute('''
-            SELECT u.id, u.username, u.phone, fm.relationship_name, fm.added_at
-            FROM family_members fm
-            JOIN users u ON fm.member_id = u.id
-            WHERE fm.user_id = ? AND fm.status = 1
-            ORDER BY fm.added_at DESC
-        ''', (user_id,)).fetchall()
-        
-        conn.close()
+        with db_connection() as conn:
+            members = conn.execute('''
+                SELECT u.id, u.username, u.phone, fm.relationship_name, fm.added_at
+                FROM family_members fm
+                JOIN users u ON fm.member_id = u.id
+                WHERE fm.user_id = ? AND fm.status = 1
+                ORDER BY fm.added_at DESC
+            ''', (user_id,)).fetchall()
         
         result = []
         for member in members:
@@ -1263,23 +3830,104 @@ def get_family_members(user_id):
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
 
 
+# 家庭页迷你趋势图可选的指标：查询参数 -> health_data列
+FAMILY_SPARKLINE_FIELDS = {
+    'steps': 'steps',
+    'heart_rate': 'avg_heart_rate',
+    'blood_oxygen': 'avg_blood_oxygen',
+    'sleep_score': 'sleep_score',
+    'calories': 'active_calories'
+}
+
+@app.route('/api/family-overview/<int:user_id>', methods=['GET'])
+def get_family_overview(user_id):
+    """家庭成员今日健康数据一次返回，避免客户端逐个请求 /api/overview。
+
+    sparkline=steps（或 heart_rate/blood_oxygen/sleep_score/calories）时附带每人最近7天的趋势，
+    只多执行一次查询
+    """
+    try:
+        sparkline = request.args.get('sparkline')
+        if sparkline is not None and sparkline not in FAMILY_SPARKLINE_FIELDS:
+            return jsonify({
+                'success': False,
+                'message': f'sparkline参数无效，可选: {", ".join(FAMILY_SPARKLINE_FIELDS)}'
+            }), 400
+        
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=6)
+        today = end_date.isoformat()
+        
+        with db_connection() as conn:
+            members = conn.execute('''
+                SELECT u.id, u.username, u.avatar_url, fm.relationship_name,
+                       h.record_date, h.steps, h.current_heart_rate, h.current_blood_oxygen,
+                       h.sleep_score, h.current_mood
+                FROM family_members fm
+                JOIN users u ON fm.member_id = u.id
+                LEFT JOIN health_data h ON h.user_id = fm.member_id AND h.record_date = ?
+                WHERE fm.user_id = ? AND fm.status = 1
+                ORDER BY fm.added_at DESC
+            ''', (today, user_id)).fetchall()
+            
+            series = {}
+            if sparkline and members:
+                column = FAMILY_SPARKLINE_FIELDS[sparkline]
+                rows = conn.execute(f'''
+                    SELECT h.user_id, h.record_date, h.{column} AS value
+                    FROM family_members fm
+                    JOIN health_data h ON h.user_id = fm.member_id AND h.record_date BETWEEN ? AND ?
+                    WHERE fm.user_id = ? AND fm.status = 1
+                ''', (start_date.isoformat(), today, user_id)).fetchall()
+                for row in rows:
+                    series.setdefault(row['user_id'], {})[row['record_date']] = row['value'] or 0
+        
+        dates = [(start_date + timedelta(days=i)).isoformat() for i in range(7)]
+        result = []
+        for member in members:
+            item = {
+                'id': member['id'],
+                'username': member['username'],
+                'avatar_url': member['avatar_url'],
+                'avatar_thumb_url': avatar_thumbnail_url(member['avatar_url']),
+                'relationship_name': member['relationship_name'],
+                'has_today_data': member['record_date'] is not None,
+                'steps': member['steps'] or 0,
+                'heart_rate': member['current_heart_rate'] or 0,
+                'blood_oxygen': member['current_blood_oxygen'] or 0,
+                'sleep_score': member['sleep_score'] or 0,
+                'current_mood': member['current_mood'] if member['current_mood'] is not None else -1
+            }
+            if sparkline:
+                values = series.get(member['id'], {})
+                item['sparkline'] = [values.get(date, 0) for date in dates]
+            result.append(item)
+        
+        response = {'success': True, 'date': today, 'members': result}
+        if sparkline:
+            response['sparkline_field'] = sparkline
+            response['sparkline_dates'] = dates
+        return jsonify(response)
+        
+    except Exception as e:
+        log_event(logging.ERROR, 'family_overview.error', '获取家庭健康概览异常', error=str(e))
+        return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
+
+
 @app.route('/api/friends-list/<int:user_id>', methods=['GET'])
 def get_friends_list(user_id):
     """获取指定用户的好友列表"""
     try:
-        print(f"[{datetime.now()}] 获取用户{user_id}的好友列表")
-        
-        conn = get_db_connection()
-        
-        friends = conn.execute('''
-            SELECT u.id, u.username, u.phone, u.avatar_url
-            FROM family_members fm
-            JOIN users u ON fm.member_id = u.id
-            WHERE fm.user_id = ? AND fm.status = 1
-            ORDER BY u.username
-        ''', (user_id,)).fetchall()
+        log_event(logging.DEBUG, 'friends.query', '获取好友列表', user_id=user_id)
         
-        conn.close()
+        with db_connection() as conn:
+            friends = conn.execute('''
+                SELECT u.id, u.username, u.phone, u.avatar_url
+                FROM family_members fm
+                JOIN users u ON fm.member_id = u.id
+                WHERE fm.user_id = ? AND fm.status = 1
+                ORDER BY u.username
+            ''', (user_id,)).fetchall()
         
         result = []
         for friend in friends:
@@ -1287,10 +3935,11 @@ def get_friends_list(user_id):
                 'id': friend['id'],
                 'username': friend['username'],  # 对应前端的 user_name
                 'phone': friend['phone'],
-                'avatar_url': friend['avatar_url'] 
+                'avatar_url': friend['avatar_url'],
+                'avatar_thumb_url': avatar_thumbnail_url(friend['avatar_url'])
             })
         
-        print(f"[{datetime.now()}] 查询成功，共{len(result)}个好友")
+        log_event(logging.DEBUG, 'friends.result', '好友列表查询成功', user_id=user_id, count=len(result))
         
         return jsonify({
             'success': True,
@@ -1299,7 +3948,7 @@ def get_friends_list(user_id):
         })
         
     except Exception as e:
-        print(f"[{datetime.now()}] 获取好友列表异常: {e}")
+        log_event(logging.ERROR, 'friends.error', '获取好友列表异常', error=str(e))
         return jsonify({
             'success': False,
             'message': f'获取失败: {str(e)}',
@@ -1314,70 +3963,51 @@ def save_ai_health_data():
         user_id = data.get('user_id')
         record_date = data.get('record_date', datetime.now().strftime('%Y-%m-%d'))
         
-        # 获取AI解析的健康数据
-        steps = data.get('steps')
-        distance = data.get('distance') 
-        calories = data.get('calories')
-        heart_rate = data.get('heart_rate')
-        blood_oxygen = data.get('blood_oxygen')
-        sleep_duration = data.get('sleep_duration')
-        
-        print(f"[{datetime.now()}] AI健康数据录入: 用户{user_id}, 日期{record_date}")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 构建更新字段
-        update_fields = []
-        values = [user_id, record_date]
-        
-        if steps is not None:
-            update_fields.append('steps = ?')
-            values.append(steps)
-        if distance is not None:
-            update_fields.append('distance = ?') 
-            values.append(distance)
-        if calories is not None:
-            update_fields.append('active_calories = ?')
-            values.append(calories)
-        if heart_rate is not None:
-            update_fields.append('avg_heart_rate = ?')
-            values.append(heart_rate)
-        if blood_oxygen is not None:
-            update_fields.append('avg_blood_oxygen = ?')
-            values.append(blood_oxygen)
-        if sleep_duration is not None:
-            update_fields.append('sleep_duration = ?')
-            values.append(sleep_duration)
-        
-        if update_fields:
-            # 使用INSERT OR REPLACE更新健康数据
-            set_clause = ', '.join(update_fields)
-            sql = f'''
-                INSERT OR REPLACE INTO health_data 
-                (user_id, record_date, {', '.join([field.split(' = ')[0] for field in update_fields])}, updated_at) 
-                VALUES (?, ?, {', '.join(['?' for _ in update_fields])}, CURRENT_TIMESTAMP)
-            '''
-            cursor.execute(sql, values)
-            
-            conn.commit()
-            conn.close()
-            
-            print(f"[{datetime.now()}] AI健康数据保存成功")
-            
-            return jsonify({
-                'success': True,
-                'message': 'AI健康数据保存成功'
-            })
-        else:
-            conn.close()
+        # AI解析字段 -> health_data列
+        ai_field_columns = {
+            'steps': 'steps',
+            'distance': 'distance',
+            'calories': 'active_calories',
+            'heart_rate': 'avg_heart_rate',
+            'blood_oxygen': 'avg_blood_oxygen',
+            'sleep_duration': 'sleep_duration'
+        }
+        provided = {
+            column: data[field] for field, column in ai_field_columns.items()
+            if data.get(field) is not None
+        }
+        
+        try:
+            # 步数排行榜以整数ID为键、按整数步数排序，写入前先统一类型
+            user_id = int(user_id)
+            if 'steps' in provided:
+                provided['steps'] = parse_steps(provided['steps'])
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': '参数格式错误'}), 400
+        
+        log_event(logging.INFO, 'ai_health_data.save', 'AI健康数据录入', user_id=user_id, record_date=record_date)
+        
+        if not provided:
             return jsonify({
                 'success': False,
                 'message': '没有有效的健康数据'
             }), 400
+        
+        # 只合并AI解析出的字段，当天其他指标保持不变
+        db_writer.run(merge_health_data, user_id, record_date, provided)
+        
+        health_data_versions.bump(user_id)
+        log_event(logging.INFO, 'ai_health_data.saved', 'AI健康数据保存成功', user_id=user_id, fields=len(provided))
+        
+        return jsonify({
+            'success': True,
+            'message': 'AI健康数据保存成功'
+        })
             
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        print(f"[{datetime.now()}] AI健康数据保存异常: {e}")
+        log_event(logging.ERROR, 'ai_health_data.error', 'AI健康数据保存异常', error=str(e))
         return jsonify({
             'success': False, 
             'message': f'保存失败: {str(e)}'
@@ -1385,64 +4015,108 @@ def save_ai_health_data():
     
 @app.route('/api/upload-avatar', methods=['POST'])
 def upload_avatar():
+    """上传头像，支持三种方式：
+    1. multipart/form-data：表单字段 user_id，文件字段 avatar_file
+    2. 原始图片：Content-Type 为 image/* 或 application/octet-stream，user_id 放在查询参数
+    3. JSON：{"user_id": ..., "avatar_file": "base64..."}（旧客户端）
+    前两种按固定大小分块写入临时文件，不在内存中保留整张图片
+    """
     try:
-        data = request.get_json()
-        user_id = data.get('user_id')
-        avatar_base64 = data.get('avatar_file')
-        
-        if not user_id or not avatar_base64:
+        content_type = request.mimetype or ''
+        streaming = content_type == 'multipart/form-data' or content_type.startswith('image/') \
+            or content_type == 'application/octet-stream'
+        
+        # 先按请求头判断大小，避免读完整个请求体才发现超限（base64 约膨胀 4/3）
+        max_length = AVATAR_MAX_BYTES + AVATAR_CHUNK_SIZE if streaming else AVATAR_MAX_BYTES * 4 // 3 + AVATAR_CHUNK_SIZE
+        if request.content_length is not None and request.content_length > max_length:
+            return jsonify({'success': False, 'message': f'图片不能超过{AVATAR_MAX_BYTES // (1024 * 1024)}MB'}), 413
+        # 没有 Content-Length 的分块上传：在读取请求体之前设置上限，表单解析和流读取超限时立即中止，
+        # 不会先把整个请求体写到临时文件
+        request.max_content_length = max_length
+        
+        if content_type == 'multipart/form-data':
+            user_id = request.form.get('user_id')
+            upload = request.files.get('avatar_file')
+            chunks = iter(lambda: upload.stream.read(AVATAR_CHUNK_SIZE), b'') if upload else None
+        elif streaming:
+            user_id = request.args.get('user_id')
+            chunks = iter(lambda: request.stream.read(AVATAR_CHUNK_SIZE), b'')
+        else:
+            data = request.get_json()
+            user_id = data.get('user_id')
+            avatar_base64 = data.get('avatar_file')
+            chunks = None
+            if avatar_base64:
+                # 解码base64图片
+                try:
+                    image_data = base64.b64decode(avatar_base64.split(',')[1] if ',' in avatar_base64 else avatar_base64)
+                except Exception as e:
+                    return jsonify({'success': False, 'message': '图片格式错误'}), 400
+                chunks = [image_data]
+        
+        if not user_id or chunks is None:
             return jsonify({'success': False, 'message': '参数缺失'}), 400
         
-        print(f"[{datetime.now()}] 头像上传请求: 用户{user_id}")
+        log_event(logging.INFO, 'avatar.upload', '头像上传请求', user_id=user_id, content_type=content_type)
         
-        # 解码base64图片
+        # 按内容哈希保存，重复上传同一张图片不会产生新文件
         try:
-            image_data = base64.b64decode(avatar_base64.split(',')[1] if ',' in avatar_base64 else avatar_base64)
-        except Exception as e:
-            return jsonify({'success': False, 'message': '图片格式错误'}), 400
-        
-        # 生成唯一文件名
-        filename = f"avatar_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-        
-        # 保存文件到服务器
-        upload_folder = 'static/avatars'
-        os.makedirs(upload_folder, exist_ok=True)
-        file_path = os.path.join(upload_folder, filename)
+            stored = store_avatar(chunks)
+        except AvatarTooLarge:
+            return jsonify({'success': False, 'message': f'图片不能超过{AVATAR_MAX_BYTES // (1024 * 1024)}MB'}), 413
+        if stored is None:
+            return jsonify({'success': False, 'message': '图片内容为空'}), 400
+        avatar_url, temp_path = stored
+        
+        # 更新数据库、发布文件、检查旧头像是否还被引用在同一个写任务中完成，旧头像文件在提交后删除。
+        # 用户不存在时不发布文件，临时文件直接丢弃
+        def replace_avatar(conn):
+            cursor = conn.cursor()
+            row = cursor.execute('SELECT avatar_url FROM users WHERE id = ?', (user_id,)).fetchone()
+            if cursor.execute('UPDATE users SET avatar_url = ? WHERE id = ?', (avatar_url, user_id)).rowcount == 0:
+                return False
+            publish_avatar(avatar_url, temp_path)
+            old_avatar_url = row['avatar_url'] if row else None
+            if old_avatar_url and old_avatar_url != avatar_url:
+                paths = orphan_avatar_paths(conn, old_avatar_url)
+                if paths:
+                    db_writer.after_commit(remove_avatar_files, paths)
+            return True
         
-        with open(file_path, 'wb') as f:
-            f.write(image_data)
-        
-        # 生成访问URL
-        avatar_url = f"/static/avatars/{filename}"
-        
-        # 更新数据库
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET avatar_url = ? WHERE id = ?', (avatar_url, user_id))
-        conn.commit()
-        conn.close()
+        try:
+            replaced = db_writer.run(replace_avatar)
+        finally:
+            # 写任务没有执行、用户不存在或在发布前失败时清理临时文件
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        if not replaced:
+            return jsonify({'success': False, 'message': '用户不存在'}), 404
         
-        print(f"[{datetime.now()}] 头像上传成功: 用户{user_id}, 文件{filename}")
+        log_event(logging.INFO, 'avatar.uploaded', '头像上传成功', user_id=user_id, avatar_url=avatar_url)
         
         return jsonify({
             'success': True,
             'message': '头像上传成功',
-            'avatar_url': avatar_url
+            'avatar_url': avatar_url,
+            'avatar_thumb_url': avatar_thumbnail_url(avatar_url)
         })
         
+    except RequestEntityTooLarge:
+        return jsonify({'success': False, 'message': f'图片不能超过{AVATAR_MAX_BYTES // (1024 * 1024)}MB'}), 413
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        print(f"[{datetime.now()}] 头像上传异常: {e}")
+        log_event(logging.ERROR, 'avatar.error', '头像上传异常', error=str(e))
         return jsonify({'success': False, 'message': f'上传失败: {str(e)}'}), 500
 
 @app.route('/api/user-profile/<int:user_id>', methods=['GET'])
 def get_user_profile(user_id):
     try:
-        conn = get_db_connection()
-        user = conn.execute('''
-            SELECT id, username, phone, avatar_url FROM users 
-            WHERE id = ?
-        ''', (user_id,)).fetchone()
-        conn.close()
+        with db_connection() as conn:
+            user = conn.execute('''
+                SELECT id, username, phone, avatar_url FROM users 
+                WHERE id = ?
+            ''', (user_id,)).fetchone()
         
         if user:
             return jsonify({
@@ -1451,7 +4125,8 @@ def get_user_profile(user_id):
                     'user_id': user['id'],
                     'username': user['username'],
                     'phone': user['phone'],
-                    'avatar_url': user['avatar_url'] or ''
+                    'avatar_url': user['avatar_url'] or '',
+                    'avatar_thumb_url': avatar_thumbnail_url(user['avatar_url'], 'medium')
                 }
             })
         else:
@@ -1467,82 +4142,361 @@ def remove_family_member():
         user_id = data.get('user_id')
         member_id = data.get('member_id')
         
-        print(f"[{datetime.now()}] 删除好友关系: 用户{user_id} -> 成员{member_id}")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 查询删除前的状态
-        before_count = cursor.execute('''
-            SELECT COUNT(*) as count FROM family_members 
-            WHERE (user_id = ? AND member_id = ?) OR (user_id = ? AND member_id = ?)
-        ''', (user_id, member_id, member_id, user_id)).fetchone()
-        print(f"[{datetime.now()}] 删除前关系数量: {before_count['count']}")
+        log_event(logging.INFO, 'family.remove', '删除好友关系', user_id=user_id, member_id=member_id)
         
         # 执行硬删除
-        cursor.execute('''
+        affected_rows = db_writer.run(lambda conn: conn.execute('''
             DELETE FROM family_members 
             WHERE (user_id = ? AND member_id = ?) OR (user_id = ? AND member_id = ?)
-        ''', (user_id, member_id, member_id, user_id))
-        
-        affected_rows = cursor.rowcount
-        print(f"[{datetime.now()}] 删除影响的行数: {affected_rows}")
-        
-        # 查询删除后的状态
-        after_count = cursor.execute('''
-            SELECT COUNT(*) as count FROM family_members 
-            WHERE (user_id = ? AND member_id = ?) OR (user_id = ? AND member_id = ?)
-        ''', (user_id, member_id, member_id, user_id)).fetchone()
-        print(f"[{datetime.now()}] 删除后关系数量: {after_count['count']}")
+        ''', (user_id, member_id, member_id, user_id)).rowcount)
         
-        conn.commit()
-        conn.close()
+        log_event(logging.INFO, 'family.removed', '删除好友关系完成', user_id=user_id,
+                  member_id=member_id, affected_rows=affected_rows)
         
         return jsonify({'success': True, 'message': f'删除好友成功，删除{affected_rows}条记录'})
         
+    except DatabaseWriteBusy:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后重试'}), 503
     except Exception as e:
-        print(f"[{datetime.now()}] 删除好友异常: {e}")
+        log_event(logging.ERROR, 'family.error', '删除好友异常', error=str(e))
         return jsonify({'success': False, 'message': f'删除失败: {str(e)}'}), 500
 
 
 
 @app.route('/api/weekly-calories/<int:user_id>', methods=['GET'])
+@health_data_etag
 def get_weekly_calories(user_id):
     try:
         end_date = datetime.now().date()
         start_date = end_date - timedelta(days=6)
         
-        conn = get_db_connection()
+        with db_connection() as conn:
+            weekly_data = conn.execute('''
+                SELECT record_date, active_calories FROM health_data 
+                WHERE user_id = ? AND record_date BETWEEN ? AND ?
+                ORDER BY record_date
+            ''', (user_id, start_date.isoformat(), end_date.isoformat())).fetchall()
         
-        weekly_data = conn.execute('''
-            SELECT record_date, active_calories FROM health_data 
-            WHERE user_id = ? AND record_date BETWEEN ? AND ?
-            ORDER BY record_date
-        ''', (user_id, start_date.isoformat(), end_date.isoformat())).fetchall()
+        result = weekly_calories_payload(weekly_data)
         
-        conn.close()
+        return jsonify({'success': True, 'data': result})
         
-        result = []
-        for row in weekly_data:
-            result.append({
-                'date': row['record_date'], 
-                'calories': row['active_calories'] or 0
-            })
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
+
+
+@app.route('/api/dashboard/<int:user_id>', methods=['GET'])
+@health_data_etag
+def get_dashboard(user_id):
+    """首页一次取齐：今日概览和最近7天的步数/睡眠/卡路里，只查询一次 health_data。
+
+    fields 参数按逗号选择需要的面板，如 fields=overview,weekly_steps，默认全部返回
+    """
+    try:
+        fields_param = request.args.get('fields')
+        fields = [f.strip() for f in fields_param.split(',') if f.strip()] if fields_param else list(DASHBOARD_PANELS)
+        unknown = [f for f in fields if f not in DASHBOARD_PANELS]
+        if unknown:
+            return jsonify({
+                'success': False,
+                'message': f'未知的面板: {", ".join(unknown)}，可选: {", ".join(DASHBOARD_PANELS)}'
+            }), 400
+        
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=6)
+        
+        with db_connection() as conn:
+            weekly_data = conn.execute('''
+                SELECT record_date, steps, current_heart_rate, sleep_score, sleep_duration,
+                       active_calories, basic_metabolism_calories, current_blood_oxygen, current_mood
+                FROM health_data
+                WHERE user_id = ? AND record_date BETWEEN ? AND ?
+                ORDER BY record_date
+            ''', (user_id, start_date.isoformat(), end_date.isoformat())).fetchall()
+        
+        today = end_date.isoformat()
+        result = {}
+        for field in fields:
+            if field == 'overview':
+                today_row = next((row for row in weekly_data if row['record_date'] == today), None)
+                result[field] = overview_payload(today_row)
+            else:
+                result[field] = DASHBOARD_PANELS[field](weekly_data)
         
         return jsonify({'success': True, 'data': result})
         
     except Exception as e:
+        log_event(logging.ERROR, 'dashboard.error', '获取首页数据异常', error=str(e))
         return jsonify({'success': False, 'message': f'获取失败: {str(e)}'}), 500
 
+# ==================== 后台维护任务 ====================
+
+MAINTENANCE_JITTER = 0.1                 # 每次执行时间在间隔基础上随机浮动 ±10%
+POINTS_HISTORY_RETENTION_DAYS = int(os.environ.get('POINTS_HISTORY_RETENTION_DAYS', 730))
+RETENTION_BATCH_SIZE = 5000              # 每个事务最多删除的行数，避免长时间占用写锁
+INCREMENTAL_VACUUM_PAGES = 2000          # 每次最多归还给文件系统的空闲页数
+# 旧数据库切换为增量 auto_vacuum 需要一次重写整库的 VACUUM，只在显式开启时于服务启动前执行
+AUTO_VACUUM_CONVERT = os.environ.get('AUTO_VACUUM_CONVERT', '0').lower() in ('1', 'true', 'yes')
+
+class MaintenanceScheduler:
+    """进程内的定时维护任务调度器，所有任务在一个后台线程中依次执行，不占用请求线程。
+
+    每次执行前在 maintenance_leases 表中抢占该任务本周期的租约，
+    多个进程同时运行时同一任务每个周期只会执行一次。
+    """
+
+    def __init__(self, jitter=MAINTENANCE_JITTER):
+        self.jitter = jitter
+        self.owner = f'{os.getpid()}-{int(time.time())}'
+        self._jobs = {}
+        self._next_run = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def job(self, name, interval):
+        """注册维护任务，interval 为执行间隔（秒），任务返回值记录在指标中"""
+        def decorator(func):
+            self._jobs[name] = (func, interval)
+            self._metrics[name] = {
+                'interval': interval, 'runs': 0, 'failures': 0, 'skipped': 0,
+                'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': None,
+                'last_run_at': None, 'last_result': None, 'last_error': None
+            }
+            return func
+        return decorator
+
+    def _delay(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        now = time.monotonic()
+        # 首次执行也错开，避免刚启动时所有任务同时运行
+        for name, (_, interval) in self._jobs.items():
+            self._next_run[name] = now + min(interval, 60) * random.uniform(0.5, 1)
+        self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+        self._thread.start()
+        log_event(logging.INFO, 'maintenance.start', '后台维护任务已启动', jobs=list(self._jobs))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            name = min(self._next_run, key=self._next_run.get)
+            delay = self._next_run[name] - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+                continue
+            self.run_job(name)
+            self._next_run[name] = time.monotonic() + self._delay(self._jobs[name][1])
+
+    def _acquire_lease(self, name, interval):
+        now = time.time()
+        acquired = db_writer.run(lambda conn: conn.execute('''
+            INSERT INTO maintenance_leases (job, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (job) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE maintenance_leases.expires_at <= ?
+        ''', (name, self.owner, now + interval * (1 - self.jitter), now)).rowcount)
+        return acquired == 1
+
+    def run_job(self, name):
+        """立即执行一次任务（租约被其他进程持有时跳过），返回任务结果"""
+        func, interval = self._jobs[name]
+        metrics = self._metrics[name]
+        try:
+            if not self._acquire_lease(name, interval):
+                with self._lock:
+                    metrics['skipped'] += 1
+                return None
+        except Exception as e:
+            log_event(logging.WARNING, 'maintenance.lease_error', '维护任务抢占租约失败', job=name, error=str(e))
+            with self._lock:
+                metrics['skipped'] += 1
+            return None
+
+        started = time.perf_counter()
+        result, error = None, None
+        try:
+            result = func()
+        except Exception as e:
+            error = str(e)
+            log_event(logging.ERROR, 'maintenance.error', '维护任务执行失败', job=name, error=error)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            metrics['runs'] += 1
+            metrics['failures'] += error is not None
+            metrics['total_ms'] += elapsed_ms
+            metrics['max_ms'] = max(metrics['max_ms'], elapsed_ms)
+            metrics['last_ms'] = round(elapsed_ms, 2)
+            metrics['last_run_at'] = datetime.now().isoformat(timespec='seconds')
+            metrics['last_result'] = result
+            metrics['last_error'] = error
+        if error is None:
+            log_event(logging.INFO, 'maintenance.done', '维护任务完成', job=name,
+                      elapsed_ms=round(elapsed_ms, 2), result=result)
+        return result
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            jobs = {}
+            for name, metrics in self._metrics.items():
+                item = {key: value for key, value in metrics.items() if key != 'total_ms'}
+                item['avg_ms'] = round(metrics['total_ms'] / metrics['runs'], 2) if metrics['runs'] else None
+                item['max_ms'] = round(metrics['max_ms'], 2)
+                if name in self._next_run:
+                    item['next_run_in'] = round(max(0, self._next_run[name] - now), 1)
+                jobs[name] = item
+        return {'running': self._thread is not None and not self._stop.is_set(), 'jobs': jobs}
+
+maintenance_scheduler = MaintenanceScheduler()
+atexit.register(maintenance_scheduler.stop)
+
+def delete_in_batches(delete_sql, params, batch_size=RETENTION_BATCH_SIZE):
+    """分批执行带 LIMIT 子查询的删除语句，每批作为一个写任务提交，返回删除总行数"""
+    deleted = 0
+    while True:
+        count = db_writer.run(lambda conn: conn.execute(delete_sql, (*params, batch_size)).rowcount)
+        deleted += count
+        if count < batch_size:
+            return deleted
+        time.sleep(0.01)
+
+@maintenance_scheduler.job('radar_expiry', interval=60)
+def _job_radar_expiry():
+    """清理过期的雷达等待者，以及旧版遗留在 friend_radar 表中的过期记录"""
+    purged = radar_matcher.purge()
+    legacy = db_writer.run(lambda conn: conn.execute('DELETE FROM friend_radar WHERE expires_at < ?',
+                                                     (datetime.now().isoformat(),)).rowcount)
+    return {'purged': purged, 'legacy_rows': legacy}
+
+@maintenance_scheduler.job('retention', interval=6 * 3600)
+def _job_retention():
+    """按保留期删除原始实时样本、5分钟汇总和积分历史；小时/天级汇总长期保留。
+
+    原始样本按月分区，整月过期后直接删除分区文件和归档文件
+    """
+    result = {}
+    cutoff_ts = realtime_retention_cutoff()
+    if cutoff_ts is not None:
+        expired = [month for month in realtime_partitions.months(refresh=True)
+                   if month_bounds(month)[1] <= cutoff_ts]
+        for month in expired:
+            realtime_partitions.drop(month)
+        result['realtime_partitions'] = expired
+        result['realtime_archive_files'] = realtime_archive.purge(cutoff_ts)
+        result['realtime_rollups_5m'] = delete_in_batches('''
+            DELETE FROM realtime_rollups WHERE (user_id, data_type, resolution, bucket_start) IN (
+                SELECT user_id, data_type, resolution, bucket_start FROM realtime_rollups
+                WHERE resolution = 5 AND bucket_start < ? LIMIT ?
+            )
+        ''', (from_epoch_minute(cutoff_ts),))
+    if POINTS_HISTORY_RETENTION_DAYS > 0:
+        cutoff = datetime.now() - timedelta(days=POINTS_HISTORY_RETENTION_DAYS)
+        result['points_history'] = delete_in_batches('''
+            DELETE FROM points_history WHERE id IN (
+                SELECT id FROM points_history WHERE created_at < ? LIMIT ?
+            )
+        ''', (cutoff.strftime('%Y-%m-%d %H:%M:%S'),))
+    return result
+
+@maintenance_scheduler.job('realtime_archive', interval=6 * 3600)
+def _job_realtime_archive():
+    """把整月超出热数据窗口的分区转存为按用户的压缩归档；旧数据搬迁完成前不执行，避免往已归档的月份写入"""
+    archive_cutoff = realtime_archive_cutoff()
+    if archive_cutoff is None or legacy_realtime_migrator.pending:
+        return {'skipped': True}
+    retention_cutoff = realtime_retention_cutoff()
+    result = {}
+    for month in realtime_partitions.months(refresh=True):
+        month_end = month_bounds(month)[1]
+        # 已过保留期的月份由 retention 任务直接删除
+        if month_end <= archive_cutoff and (retention_cutoff is None or month_end > retention_cutoff):
+            result[month] = realtime_archive.archive_month(month)
+    return result
+
+@maintenance_scheduler.job('realtime_compact', interval=3600)
+def _job_realtime_compact():
+    """开启压缩块存储时，把今天之前的逐行样本压成按天的块"""
+    if not REALTIME_BLOCK_STORAGE:
+        return {'skipped': True}
+    before_ts = to_epoch_minute(datetime.now().strftime('%Y-%m-%d 00:00'))
+    return {month: realtime_blocks.compact_month(month, before_ts)
+            for month in realtime_partitions.months(refresh=True) if month_bounds(month)[0] < before_ts}
+
+def convert_to_incremental_vacuum():
+    """把数据库切换为增量 auto_vacuum，返回是否执行了转换。
+
+    完整 VACUUM 会重写整个数据库并长时间占用写锁，只应在开始处理请求之前执行
+    （AUTO_VACUUM_CONVERT=1 启动时），不放进定时任务
+    """
+    with db_connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        started = time.perf_counter()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    log_event(logging.INFO, 'db.auto_vacuum_converted', '数据库已切换为增量 auto_vacuum',
+              elapsed_ms=round((time.perf_counter() - started) * 1000, 2))
+    return True
+
+@maintenance_scheduler.job('incremental_vacuum', interval=6 * 3600)
+def _job_incremental_vacuum():
+    """归还空闲页，只处理已经是增量 auto_vacuum 的数据库；旧数据库需先用 AUTO_VACUUM_CONVERT 转换"""
+    def vacuum(conn):
+        mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if mode != 2:
+            return {'skipped': True, 'auto_vacuum': mode}
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.execute(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})').fetchall()
+        return {'free_pages_before': free_pages, 'free_pages_after': conn.execute('PRAGMA freelist_count').fetchone()[0]}
+
+    # 维护任务不急于开始，排队等待的时间放宽
+    return db_writer.run(vacuum, timeout=300)
+
+@maintenance_scheduler.job('optimize', interval=3600)
+def _job_optimize():
+    """刷新查询规划器统计信息，analysis_limit 限制每个索引的采样行数"""
+    def optimize(conn):
+        conn.execute('PRAGMA analysis_limit = 400')
+        conn.execute('PRAGMA optimize')
+
+    db_writer.run(optimize, timeout=300)
+    return {'ok': True}
+
+@maintenance_scheduler.job('wal_checkpoint', interval=300)
+def _job_wal_checkpoint():
+    """把WAL中的页写回数据库文件，PASSIVE 模式不会阻塞读写"""
+    with db_connection() as conn:
+        busy, log_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    return {'busy': busy, 'log_frames': log_frames, 'checkpointed': checkpointed}
 
 
 if __name__ == '__main__':
     init_database()
+    if AUTO_VACUUM_CONVERT:
+        convert_to_incremental_vacuum()
+    points_leaderboard.rebuild()
+    debug = True
+    # 开启 reloader 时父进程只负责监视文件变化，bcrypt 校准和后台任务只在实际处理请求的子进程中进行
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        password_hasher.calibrate()
+        legacy_realtime_migrator.start()
+        maintenance_scheduler.start()
     print("=" * 50)
     print("🚀 用户注册登录后端服务")
     print(f"📊 数据库: SQLite ({DATABASE_PATH})")
+    if password_hasher.rounds is not None:
+        print(f"🔐 bcrypt cost: {password_hasher.rounds} (目标 {BCRYPT_TARGET_MS:g}ms)")
     print(f"🌐 服务地址: http://localhost:5000")
     print(f"👤 开发用户: gadz2021")
     print(f"📅 启动时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 50)
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=debug)
\ No newline at end of file